@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Stream task packages into zip or tar archives
+'''
+
+import os
+import string
+import sys
+import time
+import zlib
+
+from . import helper_xml
+from . import instrument
+
+
+FORMATS = ["zip", "tar"]
+CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def format_crc(crc, like=None):
+    """
+    CRC-32 as text, in hex when like is a hex value from the library
+    """
+    if like and len(like) == 8 and not like.isdigit() and all(c in string.hexdigits for c in like):
+        return "{:08X}".format(crc) if like.isupper() else "{:08x}".format(crc)
+    return str(crc)
+
+
+def crc_matches(text, crc):
+    """
+    Whether a filelist crc attribute, decimal or hex, records crc
+    """
+    if text is None:
+        return False
+    if text == str(crc):
+        return True
+    try:
+        return len(text) == 8 and int(text, 16) == crc
+    except ValueError:
+        return False
+
+
+def guess_format(output):
+    if output.endswith(".tar"):
+        return "tar"
+    return "zip"
+
+
+class CrcReader:
+    """
+    File wrapper computing size and CRC-32 of what is read through it
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.crc = 0
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        instrument.count("bytes_read", len(data))
+        return data
+
+
+# zipfile和tarfile只在写归档时导入，verify等命令只用到format_crc
+class ZipArchiveWriter:
+    def __init__(self, stream):
+        import zipfile
+        self.zip_file = zipfile.ZipFile(stream, "w")
+
+    def add_file(self, name, src_path):
+        import zipfile
+        stat = os.stat(src_path)
+        zip_info = zipfile.ZipInfo(name, date_time=time.localtime(stat.st_mtime)[:6])
+        # 图片已经压缩过，不再压缩
+        zip_info.compress_type = zipfile.ZIP_STORED
+        zip_info.file_size = stat.st_size
+        with open(src_path, "rb") as src, \
+                self.zip_file.open(zip_info, "w", force_zip64=stat.st_size >= zipfile.ZIP64_LIMIT) as dst:
+            reader = CrcReader(src)
+            for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+                dst.write(chunk)
+        instrument.count("bytes_written", reader.size)
+        return reader.size, reader.crc
+
+    def add_xml(self, name, root):
+        import zipfile
+        zip_info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        with self.zip_file.open(zip_info, "w", force_zip64=True) as dst:
+            helper_xml.write_xml(root, dst)
+
+    def close(self):
+        self.zip_file.close()
+
+
+class TarArchiveWriter:
+    def __init__(self, stream):
+        import tarfile
+        self.tar_file = tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT)
+
+    def add_file(self, name, src_path):
+        import tarfile
+        stat = os.stat(src_path)
+        tar_info = tarfile.TarInfo(name)
+        tar_info.size = stat.st_size
+        tar_info.mtime = stat.st_mtime
+        with open(src_path, "rb") as src:
+            reader = CrcReader(src)
+            self.tar_file.addfile(tar_info, reader)
+        instrument.count("bytes_written", reader.size)
+        return reader.size, reader.crc
+
+    def add_xml(self, name, root):
+        import tarfile
+        import tempfile
+        # tar需要预先知道大小，XML先写入临时文件，超过SPOOL_SIZE才落盘
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            helper_xml.write_xml(root, spool)
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = spool.tell()
+            tar_info.mtime = time.time()
+            spool.seek(0)
+            self.tar_file.addfile(tar_info, spool)
+
+    def close(self):
+        self.tar_file.close()
+
+
+WRITERS = {
+    "zip": ZipArchiveWriter,
+    "tar": TarArchiveWriter,
+}
+
+
+def write_archive(tasklist, output, archive_format=None):
+    """
+    Write the task package to output ("-" for stdout) in a single pass
+
+    Files entries go first so that their size and CRC-32, computed while
+    they are streamed, are what filelist.xml records.
+    """
+    if archive_format is None:
+        archive_format = guess_format(output)
+    if output == "-":
+        sys.stdout.flush()
+        stream = sys.stdout.buffer
+    else:
+        stream = open(output, "wb")
+    prefix = "{}/Contents/".format(tasklist.get_task_dir())
+    try:
+        with instrument.stage("write_archive", format=archive_format):
+            writer = WRITERS[archive_format](stream)
+            for file_info in list(tasklist.filelist.values()):
+                size, crc = writer.add_file(prefix + "Files/" + file_info.name, file_info.path)
+                # 素材库记录的crc正确时原样保留，否则按素材库的格式重新记录
+                if file_info.size != str(size) or not crc_matches(file_info.crc, crc):
+                    tasklist.replace_asset(file_info.name, size=str(size), crc=format_crc(crc, like=file_info.crc))
+            for name, root in tasklist.render().items():
+                writer.add_xml(prefix + name, root)
+            writer.close()
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+        else:
+            stream.flush()
+
+
+def test_write_archive(tmp_path):
+    import io
+    import tarfile
+    import xml.etree.ElementTree as ET
+    import zipfile
+    from . import core
+
+    image_path = str(tmp_path / "a.JPG")
+    with open(image_path, "wb") as f:
+        f.write(b"jpeg" * 1000)
+    tasklist = core.TaskList("test", startdate=time.localtime(), stopdate=time.localtime(), stable_ids=True)
+    tasklist.set_filelist({"a.JPG": core.Asset("a.JPG", image_path, "1", "0")})
+
+    for archive_format in FORMATS:
+        output = str(tmp_path / ("package." + archive_format))
+        write_archive(tasklist, output, archive_format)
+        prefix = tasklist.get_task_dir() + "/Contents/"
+        if archive_format == "zip":
+            with zipfile.ZipFile(output) as zip_file:
+                assert zip_file.getinfo(prefix + "Files/a.JPG").compress_type == zipfile.ZIP_STORED
+                assert zip_file.read(prefix + "Files/a.JPG") == b"jpeg" * 1000
+                filelist_xml = zip_file.read(prefix + "filelist.xml")
+        else:
+            with tarfile.open(output) as tar_file:
+                assert tar_file.extractfile(prefix + "Files/a.JPG").read() == b"jpeg" * 1000
+                filelist_xml = tar_file.extractfile(prefix + "filelist.xml").read()
+        file_elm = ET.parse(io.BytesIO(filelist_xml)).find("*/file")
+        assert file_elm.get("size") == "4000"
+        assert file_elm.get("crc") == format_crc(zlib.crc32(b"jpeg" * 1000))
+
+    # 素材库中正确的crc保持原来的写法
+    library_crc = "{:08X}".format(zlib.crc32(b"jpeg" * 1000))
+    tasklist.set_filelist({"a.JPG": core.Asset("a.JPG", image_path, "4000", library_crc)})
+    write_archive(tasklist, str(tmp_path / "package.zip"))
+    assert tasklist.filelist["a.JPG"].crc == library_crc
+    tasklist.set_filelist({"a.JPG": core.Asset("a.JPG", image_path, "4000", "0000ABCD")})
+    write_archive(tasklist, str(tmp_path / "package.zip"))
+    assert tasklist.filelist["a.JPG"].crc == library_crc
+    assert crc_matches(library_crc.lower(), zlib.crc32(b"jpeg" * 1000))
+    assert not crc_matches("0", zlib.crc32(b"jpeg" * 1000))
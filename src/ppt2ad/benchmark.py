@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Benchmarks on a synthetic workspace
+
+    python -m ppt2ad.benchmark --images 2000 --image-size 0.5 --boards 4 -o bench.json
+'''
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+from . import cache
+from . import cmdline
+from . import core
+from . import helper_xml
+from . import sched
+from . import folders
+from .commands import build as build_command
+
+
+CATEGORY_FOLDERS = ["早读", "午休", "课间", "课间操", "放学", "通用", "班级文化"]
+
+
+def get_course_names(timetable=sched.DEFAULT_TIMETABLE):
+    return ["{}-{}.JPG".format(week_day + 1, instance) for week_day, instance in sorted(timetable.classes)]
+
+
+def write_image(path, rng, size):
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, core.CHUNK_SIZE)
+            f.write(rng.randbytes(chunk))
+            remaining -= chunk
+
+
+def create_workspace(root, images=200, image_size=64 * 1024, boards=1, unused=None, seed=0):
+    """
+    Build images/, Contents/filelist.xml, Contents/Files and boards.json
+
+    Course slides D-N.JPG are created for every class in the default
+    timetable; the remaining images are spread over the category folders.
+    Contents/Files holds a copy of every image plus `unused` unreferenced
+    library files (as many as images by default).
+    """
+    rng = random.Random(seed)
+    if unused is None:
+        unused = images
+    files_dir = os.path.join(root, "Contents", "Files")
+    os.makedirs(files_dir, exist_ok=True)
+
+    sources = []
+    course_dir = os.path.join(root, "images", "课程")
+    os.makedirs(course_dir, exist_ok=True)
+    for name in get_course_names():
+        sources.append(os.path.join(course_dir, name))
+    for folder in CATEGORY_FOLDERS:
+        os.makedirs(os.path.join(root, "images", folder), exist_ok=True)
+    for index in range(max(images - len(sources), len(CATEGORY_FOLDERS))):
+        folder = CATEGORY_FOLDERS[index % len(CATEGORY_FOLDERS)]
+        sources.append(os.path.join(root, "images", folder, "{:05d}.JPG".format(index)))
+
+    entries = []
+    for index, source in enumerate(sources):
+        write_image(source, rng, image_size)
+        name = "{:05d}.JPG".format(index)
+        shutil.copyfile(source, os.path.join(files_dir, name))
+        entries.append(name)
+    for index in range(unused):
+        name = "unused-{:05d}.JPG".format(index)
+        write_image(os.path.join(files_dir, name), rng, image_size)
+        entries.append(name)
+
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', "<config>", '    <filelist taskid="0" taskname="bench" ver="0">']
+    for name in entries:
+        file_path = os.path.join(files_dir, name)
+        with open(file_path, "rb") as f:
+            crc = zlib.crc32(f.read())
+        lines.append('        <file crc="{}" name="{}" size="{}"/>'.format(crc, name, os.path.getsize(file_path)))
+    lines.extend(["    </filelist>", "</config>", ""])
+    with open(os.path.join(root, "Contents", "filelist.xml"), "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+    with open(os.path.join(root, "boards.json"), "w", encoding="utf-8") as f:
+        json.dump([{"name": "board-{}".format(index)} for index in range(boards)], f)
+    return sources
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "median": statistics.median(timings), "repeat": repeat}
+
+
+def measure_memory(func, count):
+    """
+    Memory still allocated per call after count calls whose results are kept
+    """
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        results = [func(index) for index in range(count)]
+        allocated = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    return {"bytes_per_call": allocated // count, "count": count}
+
+
+def measure_startup(argv, repeat=5):
+    """
+    Best wall time of a fresh interpreter run with argv, able to import ppt2ad
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + argv, env=env, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def build_args(name):
+    return cmdline.create_parser("build").parse_args(["build", "-n", name, "-q", "--no-cache"])
+
+
+def run_benchmarks(workspace, repeat=3, boards=1):
+    cwd = os.getcwd()
+    os.chdir(workspace)
+    try:
+        return _run_benchmarks(repeat, boards)
+    finally:
+        os.chdir(cwd)
+
+
+def _run_benchmarks(repeat, boards):
+    startdate = time.strptime("2021-03-15", "%Y-%m-%d")
+    stopdate = time.strptime("2022-04-30", "%Y-%m-%d")
+    filelist_path = os.path.join("Contents", "filelist.xml")
+    folder_index = folders.FolderIndex("images")
+    image_paths = folder_index.get_all()
+    course_paths = folder_index.get("课程")
+
+    def new_tasklist():
+        tasklist = core.TaskList("bench", startdate=startdate, stopdate=stopdate)
+        tasklist.verbose = False
+        tasklist.load_filelist(filelist_path)
+        return tasklist
+
+    def search_image():
+        new_tasklist().search_image(image_paths)
+
+    def build_boards():
+        for index in range(boards):
+            build_command.build(build_args("board-{}".format(index)))
+
+    # 与batch相同，各看板共用一份素材库
+    shared_filelist = core.load_filelist(filelist_path)
+    shared_folder_index = folders.FolderIndex("images")
+    shared_digests = cache.MemoryDigestCache()
+
+    def build_resident(index):
+        return build_command.build(build_args("board-{}".format(index)), digest_cache=shared_digests,
+                                   filelist=build_command.copy_filelist(shared_filelist),
+                                   folder_index=shared_folder_index)
+
+    tasklist = new_tasklist()
+    for index in range(0, len(image_paths), 20):
+        program = core.Program("bench")
+        program.create_imagerect(tasklist.search_image(image_paths[index:index + 20]))
+        tasklist.programlist.append(program)
+    playlist = tasklist.create_playlist_xml()
+
+    return {
+        "scan_folders": measure(lambda: folders.FolderIndex("images"), repeat),
+        "load_filelist": measure(lambda: core.SizeIndex(core.load_filelist(filelist_path)), repeat),
+        "search_image": measure(search_image, repeat),
+        "calc_class_schedule_from_images": measure(
+            lambda: sched.calc_class_schedule_from_images(course_paths), repeat),
+        "prettify_xml": measure(lambda: helper_xml.prettify_xml(playlist), repeat),
+        "write_xml": measure(lambda: helper_xml.write_xml(playlist, io.BytesIO()), repeat),
+        "playlist_xml": measure(lambda: helper_xml.write_xml(
+            tasklist.create_playlist_xml(tasklist.fragment_cache), io.BytesIO()), repeat),
+        "save": measure(build_boards, repeat),
+        "board_memory": measure_memory(build_resident, max(boards, 2)),
+        "startup": {
+            "interpreter": measure_startup(["-c", "import argparse"], repeat),
+            "version": measure_startup(["-m", "ppt2ad", "--version"], repeat),
+            "query_help": measure_startup(["-m", "ppt2ad", "query", "--help"], repeat),
+        },
+    }
+
+
+def test_run_benchmarks(tmp_path):
+    create_workspace(str(tmp_path), images=60, image_size=2048, unused=10)
+    results = run_benchmarks(str(tmp_path), repeat=1)
+    assert set(results) == {"scan_folders", "load_filelist", "search_image", "calc_class_schedule_from_images",
+                            "prettify_xml", "write_xml", "playlist_xml", "save", "board_memory", "startup"}
+    assert all(result["min"] >= 0 for name, result in results.items() if name not in ["board_memory", "startup"])
+    assert results["board_memory"]["bytes_per_call"] > 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m ppt2ad.benchmark")
+    parser.add_argument("--images", type=int, default=200, help="number of source images")
+    parser.add_argument("--image-size", type=float, default=0.0625, help="size of each image in MB")
+    parser.add_argument("--boards", type=int, default=1, help="number of boards built by the save benchmark")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workspace", help="keep the generated workspace in this directory")
+    parser.add_argument("-o", "--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    workspace = args.workspace or tempfile.mkdtemp(prefix="ppt2ad-bench-")
+    try:
+        create_workspace(workspace, images=args.images, image_size=int(args.image_size * 1024 * 1024),
+                         boards=args.boards)
+        results = run_benchmarks(workspace, repeat=args.repeat, boards=args.boards)
+    finally:
+        if args.workspace is None:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    report = {
+        "params": {"images": args.images, "image_size_mb": args.image_size, "boards": args.boards,
+                   "repeat": args.repeat},
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    content = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(content + "\n")
+    else:
+        print(content)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Persistent digest cache
+'''
+
+import os
+import sqlite3
+import time
+
+
+DEFAULT_CACHE_PATH = ".ppt2ad-cache.sqlite"
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+
+class DigestCache:
+    """
+    Map (absolute path, size, mtime_ns, inode) to the MD5 digest of a file
+
+    Entries whose stat key no longer matches are recomputed and replaced,
+    entries not used for max_age seconds are dropped on close().
+    """
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_age=DEFAULT_MAX_AGE):
+        self.db_path = db_path
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.used = {}
+        self.pending = {}
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, digest TEXT, used REAL)"
+        )
+
+    def lookup(self, file_path, stat=None):
+        """
+        Return the cached digest, or None and remember the stat key for store()
+        """
+        path = os.path.abspath(file_path)
+        if stat is None:
+            stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, inode, digest FROM digests WHERE path = ?", (path,)
+        ).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            self.hits += 1
+            self.used[path] = time.time()
+            return row[3]
+        self.misses += 1
+        self.pending[path] = key
+        return None
+
+    def store(self, file_path, digest):
+        path = os.path.abspath(file_path)
+        key = self.pending.pop(path, None)
+        if key is None:
+            stat = os.stat(path)
+            key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+            (path, key[0], key[1], key[2], digest, time.time()),
+        )
+
+    def get(self, file_path, compute, stat=None):
+        digest = self.lookup(file_path, stat=stat)
+        if digest is None:
+            digest = compute(file_path)
+            self.store(file_path, digest)
+        return digest
+
+    def expire(self):
+        deadline = time.time() - self.max_age
+        self.conn.execute("DELETE FROM digests WHERE used < ?", (deadline,))
+
+    def flush(self):
+        self.conn.executemany(
+            "UPDATE digests SET used = ? WHERE path = ?",
+            [(used, path) for path, used in self.used.items()],
+        )
+        self.used.clear()
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.expire()
+        self.conn.commit()
+        self.conn.close()
+
+    def summary(self):
+        return "digest cache: {} hits, {} misses".format(self.hits, self.misses)
+
+
+class MemoryDigestCache:
+    """
+    Digests kept in memory, optionally in front of a persistent parent cache
+
+    Used to share digests with batch worker processes and to avoid asking
+    the parent again for images used by several programs.
+    """
+    def __init__(self, digests=None, parent=None):
+        self.digests = dict(digests or {})
+        self.parent = parent
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, file_path, stat=None):
+        digest = self.digests.get(file_path)
+        if digest is None and self.parent is not None:
+            digest = self.parent.lookup(file_path, stat=stat)
+            if digest is not None:
+                self.digests[file_path] = digest
+        if digest is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return digest
+
+    def store(self, file_path, digest):
+        self.digests[file_path] = digest
+        if self.parent is not None:
+            self.parent.store(file_path, digest)
+
+    def get(self, file_path, compute, stat=None):
+        digest = self.lookup(file_path, stat=stat)
+        if digest is None:
+            digest = compute(file_path)
+            self.store(file_path, digest)
+        return digest
+
+    def invalidate(self, file_paths):
+        """
+        Forget the digests of changed files, the parent validates by stat itself
+        """
+        changed = set(os.path.normpath(file_path) for file_path in file_paths)
+        for file_path in list(self.digests):
+            if os.path.normpath(file_path) in changed:
+                del self.digests[file_path]
+
+    def flush(self):
+        if self.parent is not None:
+            self.parent.flush()
+
+    def close(self):
+        if self.parent is not None:
+            self.parent.close()
+
+    def summary(self):
+        return "digest cache: {} hits, {} misses".format(self.hits, self.misses)
+
+
+def test_digest_cache(tmp_path):
+    import hashlib
+
+    def compute(file_path):
+        computed.append(file_path)
+        with open(file_path, "rb") as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    computed = []
+    image_path = str(tmp_path / "a.JPG")
+    with open(image_path, "wb") as f:
+        f.write(b"jpeg")
+    db_path = str(tmp_path / "cache.sqlite")
+    cache = DigestCache(db_path)
+    digest = cache.get(image_path, compute)
+    assert cache.get(image_path, compute) == digest
+    cache.close()
+
+    cache = DigestCache(db_path)
+    assert cache.get(image_path, compute) == digest
+    assert len(computed) == 1 and (cache.hits, cache.misses) == (1, 0)
+    # 文件变化后按stat判断为过期，重新计算
+    with open(image_path, "wb") as f:
+        f.write(b"jpeg jpeg")
+    assert cache.get(image_path, compute) == hashlib.md5(b"jpeg jpeg").hexdigest()
+    assert len(computed) == 2 and (cache.hits, cache.misses) == (1, 1)
+    assert cache.summary() == "digest cache: 1 hits, 1 misses"
+
+    # 长期未使用的条目在close()时删除
+    cache.flush()
+    cache.conn.execute("UPDATE digests SET used = ?", (time.time() - DEFAULT_MAX_AGE - 1,))
+    cache.close()
+    cache = DigestCache(db_path)
+    assert cache.lookup(image_path) is None
+    cache.close()
@@ -1,88 +1,87 @@
 import argparse
-import collections
-import os
-import pkgutil
-import re
-import time
-
-from . import core
-from . import sched
-
-
-def get_image_paths_from_folders(folders):
-    image_paths = []
-    for folder in folders:
-        image_dir = os.path.join("images", folder)
-        filenames = os.listdir(image_dir)
-        filepaths = [os.path.join(image_dir, filename) for filename in filenames if filename.endswith(".JPG")]
-        image_paths.extend(filepaths)
-    return image_paths
-
-
-def get_image_paths(category):
-    image_paths = []
-    mapping = {
-        "早读": ["早读"],
-        "午休": ["午休"],
-        "课间": ["课间", "通用"],
-        "课间操": ["课间操", "通用"],
-        "放学": ["放学", "通用"],
-    }
-    if category in mapping.keys():
-        folders = mapping.get(category)
-        image_paths.extend(get_image_paths_from_folders(folders))
-    else:
-        if re.match("\d-\d", category):
-            image_paths.append(os.path.join("images", "课程", category + ".JPG"))
-            image_paths.extend(get_image_paths_from_folders(["班级文化"]))
-    return image_paths
-
-
-def main():
-    """Entry point"""
+import importlib
+import sys
+
+
+# 子命令在ppt2ad.commands下各有一个模块，只导入实际执行的那一个，
+# 这样查询等小命令不必加载生成任务包所需的模块
+COMMANDS = {
+    "build": "生成单个班牌的任务包（默认）",
+    "batch": "并发生成多个班牌的任务包",
+    "watch": "监视图片目录和素材库，有变化时重新生成任务包",
+    "query": "查询已生成任务在某一时刻或时间段播放的节目",
+    "verify": "校验任务包中的XML引用和文件大小、校验和",
+    "publish": "上传任务目录，只传输目标端没有的文件",
+    "gc": "删除共享素材库中不再被任何任务引用的文件",
+}
+SUBCOMMANDS = list(COMMANDS)
+# 除解释器启动和导入argparse外，允许的启动耗时（秒）
+STARTUP_BUDGET = 0.1
+
+
+class VersionAction(argparse.Action):
+    """
+    Print VERSION.txt, which is only read when --version is given
+    """
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super().__init__(option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        import pkgutil
+        version = pkgutil.get_data(__package__, "VERSION.txt").decode(encoding="utf-8")
+        print(version.strip())
+        parser.exit()
+
+
+def load_command(name):
+    return importlib.import_module("{}.commands.{}".format(__package__, name))
+
+
+def create_parser(command=None):
+    """
+    Parser listing every subcommand, with the arguments of command only
+    """
     parser = argparse.ArgumentParser(prog="ppt2ad")
-    version = pkgutil.get_data(__package__, "VERSION.txt").decode(encoding="utf-8")
-    parser.add_argument ("-v", "--version", action="version", version=version)
-    parser.add_argument ("-n", "--name", help="班牌名称")
-    parser.add_argument ("--start", help="起始日期")
-    parser.add_argument ("--stop", help="结束日期")
-
-    args = parser.parse_args()
-
-    startdate = time.strptime("2021-03-15", "%Y-%m-%d")
-    stopdate = time.strptime("2022-04-30", "%Y-%m-%d")
-    taskname = time.strftime("%Y%m%d%H%M%S")
-    if args.name:
-        taskname = args.name
-    if args.start:
-        startdate = time.strptime(args.start, "%Y-%m-%d")
-    if args.stop:
-        stopdate = time.strptime(args.stop, "%Y-%m-%d")
-
-    tasklist = core.TaskList(taskname, startdate=startdate, stopdate=stopdate)
-    tasklist.load_filelist(os.path.join("Contents", "filelist.xml"))
-
-    programs = {}
-    class_image_paths = get_image_paths_from_folders(["课程"])
-    schedules = sched.calc_class_schedule_from_images(class_image_paths)
-    for schedule in schedules:
-        category, week_days, instance, starttime, stoptime, minutes = schedule
-        if category in ["早读", "课间", "课间操", "午休", "放学"]:
-            program_name = category
-            if program_name not in programs:
-                programs[program_name] = tasklist.create_program(program_name, image_paths=get_image_paths(program_name))
-            program = programs[program_name]
-        elif category == "课程":
-            program_name = "周{}第{}节".format("一二三四五"[week_days[0]], "零一二三四五六七八"[instance])
-            if program_name not in programs:
-                image_category = "{}-{}".format(week_days[0] + 1, instance)
-                programs[program_name] = tasklist.create_program(program_name, image_paths=get_image_paths(image_category))
-            program = programs[program_name]
-        tasklist.add_schedule(program, starttime=starttime, stoptime=stoptime, week_days=week_days, minutes=minutes)
-
-    tasklist.consolidate()
-    tasklist.save()
-
-
-if __name__ == "__main__":
-    main()
+    parser.add_argument ("-v", "--version", action=VersionAction)
+    subparsers = parser.add_subparsers(dest="command")
+    for name, help in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help)
+        if name == command:
+            module = load_command(name)
+            module.add_arguments(subparser)
+            subparser.set_defaults(func=module.main)
+    return parser
+
+
+def main(argv=None):
+    """Entry point"""
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or (argv[0] not in SUBCOMMANDS and argv[0] not in ["-h", "--help", "-v", "--version"]):
+        argv = ["build"] + list(argv)
+
+    parser = create_parser(argv[0])
+    args = parser.parse_args(argv)
+    sys.exit(args.func(args))
+
+
+def test_startup_imports():
+    import os
+    import subprocess
+    code = ("import sys\nfrom ppt2ad import cmdline\ncmdline.create_parser(sys.argv[1])\n"
+            "print(' '.join(sys.modules))")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    heavy = {"ppt2ad.core", "xml.dom.minidom", "asyncio", "PIL", "sqlite3", "zipfile", "tarfile"}
+    for command, allowed in [("query", set()), ("verify", set()), ("gc", set()), ("publish", {"asyncio", "ppt2ad.core"})]:
+        output = subprocess.run([sys.executable, "-c", code, command], env=env, stdout=subprocess.PIPE,
+                                check=True).stdout.decode("utf-8")
+        assert heavy & set(output.split()) == allowed, command
+
+
+def test_startup_budget():
+    from . import benchmark
+    baseline = benchmark.measure_startup(["-c", "import argparse"])
+    for argv in [["--version"], ["query", "--help"], ["verify", "--help"]]:
+        elapsed = benchmark.measure_startup(["-m", "ppt2ad"] + argv)
+        assert elapsed - baseline < STARTUP_BUDGET, (argv, elapsed, baseline)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Subcommands of the ppt2ad command line
+
+Each module provides add_arguments(parser) and main(args) and is only
+imported by cmdline when its subcommand runs.
+'''
+
+import argparse
+
+
+def positive_int(value):
+    """
+    argparse type for thread, process and connection counts
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: {}".format(value))
+    return number
+
+
+def test_positive_int():
+    import pytest
+    from .. import cmdline
+    parser = cmdline.create_parser("build")
+    assert parser.parse_args(["build", "--hash-workers", "2"]).hash_workers == 2
+    for value in ["0", "-1", "x"]:
+        with pytest.raises(SystemExit):
+            parser.parse_args(["build", "--hash-workers", value])
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+batch subcommand: generate the task packages of many boards in parallel
+'''
+
+import concurrent.futures
+import os
+import re
+import sys
+
+from .. import cache
+from .. import core
+from .. import dedup
+from .. import folders
+from . import build
+from . import positive_int
+
+
+def add_arguments(parser):
+    parser.add_argument ("boards", help="班牌列表JSON文件，每项包含name、images、start、stop")
+    parser.add_argument ("--start", help="默认起始日期")
+    parser.add_argument ("--stop", help="默认结束日期")
+    parser.add_argument ("-j", "--jobs", type=positive_int, default=None, help="并发进程数，默认为CPU核数")
+    parser.add_argument ("--archive", metavar="DIR", help="直接生成归档，每个班牌一个 DIR/<班牌名>.zip 或 .tar")
+    build.add_build_arguments(parser)
+
+
+BATCH_STATE = {}
+
+
+def init_batch_worker(filelist, folder_indexes, digests, phashes):
+    BATCH_STATE["filelist"] = filelist
+    BATCH_STATE["folder_indexes"] = folder_indexes
+    BATCH_STATE["digest_cache"] = cache.MemoryDigestCache(digests)
+    BATCH_STATE["phash_cache"] = dedup.MemoryPerceptualHashCache(phashes)
+
+
+def build_board(args):
+    filelist = build.copy_filelist(BATCH_STATE["filelist"])
+    folder_index = BATCH_STATE["folder_indexes"][args.images]
+    tasklist = build.build(args, digest_cache=BATCH_STATE["digest_cache"], filelist=filelist, folder_index=folder_index,
+                     phash_cache=BATCH_STATE["phash_cache"])
+    return tasklist.get_task_dir()
+
+
+def get_archive_path(args, board):
+    """
+    Each board gets its own archive <archive>/<name>.<format>
+    """
+    # 班牌名称中的路径分隔符等不能出现在文件名里
+    name = re.sub(r'[\\/:*?"<>|]', "_", board["name"])
+    return os.path.join(args.archive, "{}.{}".format(name, args.archive_format or "zip"))
+
+
+def main(args):
+    if args.archive == "-":
+        # 多个进程不能同时写标准输出
+        print("batch cannot write archives to stdout, give a directory to --archive", file=sys.stderr)
+        return 2
+    boards = build.load_boards(args.boards)
+    if args.archive:
+        os.makedirs(args.archive, exist_ok=True)
+
+    digest_cache = None
+    if not args.no_cache:
+        digest_cache = cache.DigestCache()
+    filelist = core.load_filelist(os.path.join(args.contents, "filelist.xml"))
+    folder_indexes = {}
+    image_paths = []
+    stats = {}
+    for image_root in sorted(set(board.get("images", args.images) for board in boards)):
+        folder_index = folders.FolderIndex(image_root)
+        folder_indexes[image_root] = folder_index
+        image_paths.extend(folder_index.get_all())
+        stats.update(folder_index.stats)
+    matches, digests = core.match_files(image_paths, core.SizeIndex(filelist),
+                                        cache=digest_cache, workers=args.hash_workers, stats=stats)
+    # 看板只会用到和图片匹配的文件，其余文件在生成时会被裁剪掉
+    matched = {file_info.name: file_info for file_info in matches.values()}
+    phashes = {}
+    if args.normalize and args.no_prune:
+        core.hash_records(filelist.values(), cache=digest_cache, workers=args.hash_workers)
+    if args.near_duplicates:
+        # 感知哈希和转码都在这里统一完成，各进程生成时只读取结果
+        phash_cache = None if args.no_cache else dedup.PerceptualHashCache()
+        phashes = dedup.get_hashes(matched.values(), cache=phash_cache, workers=args.hash_workers)
+        if phash_cache is not None:
+            phash_cache.close()
+    if args.normalize:
+        build.create_normalizer(args).prepare(filelist if args.no_prune else matched)
+    if digest_cache is not None:
+        digest_cache.close()
+
+    failed = 0
+    initargs = (filelist, folder_indexes, digests, phashes)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=init_batch_worker,
+                                                initargs=initargs) as executor:
+        futures = {}
+        for board in boards:
+            board_args = build.get_board_args(args, board)
+            board_args.quiet = True
+            board_args.echo_xml = False
+            if args.archive:
+                board_args.archive = get_archive_path(args, board)
+            futures[executor.submit(build_board, board_args)] = board["name"]
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                task_dir = future.result()
+            except Exception as e:
+                failed += 1
+                print("FAILED {}: {}".format(name, e))
+            else:
+                print("OK     {} -> {}".format(name, task_dir))
+    print("{} boards, {} failed".format(len(boards), failed))
+    return 1 if failed else 0
+
+
+def test_batch_archives(tmp_path):
+    import json
+    import zipfile
+    from .. import benchmark
+    from .. import cmdline
+
+    benchmark.create_workspace(str(tmp_path), images=40, image_size=256, boards=3, unused=0)
+    cwd = os.getcwd()
+    os.chdir(str(tmp_path))
+    try:
+        # 名称带路径分隔符的班牌
+        boards = build.load_boards("boards.json")
+        boards[0]["name"] = "初一/1班"
+        with open("boards.json", "w", encoding="utf-8") as f:
+            json.dump(boards, f, ensure_ascii=False)
+        parser = cmdline.create_parser("batch")
+        assert main(parser.parse_args(["batch", "boards.json", "--no-cache", "--archive", "-"])) == 2
+        assert main(parser.parse_args(["batch", "boards.json", "--no-cache", "-j", "2", "--archive", "out"])) == 0
+        names = sorted(os.listdir("out"))
+        assert names == ["board-1.zip", "board-2.zip", "初一_1班.zip"]
+        task_dirs = set()
+        for name in names:
+            with zipfile.ZipFile(os.path.join("out", name)) as zip_file:
+                task_dirs.update(entry.split("/")[0] for entry in zip_file.namelist())
+        assert len(task_dirs) == 3
+    finally:
+        os.chdir(cwd)
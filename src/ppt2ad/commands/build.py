@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+build subcommand: generate the task package of one board
+'''
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+from .. import archive
+from .. import cache
+from .. import core
+from .. import dedup
+from .. import folders
+from .. import instrument
+from .. import manifest
+from .. import materialize
+from .. import normalize
+from .. import sched
+from .. import store
+from . import positive_int
+
+
+def get_image_paths_from_folders(folders, folder_index):
+    image_paths = []
+    for folder in folders:
+        image_paths.extend(folder_index.get(folder))
+    return image_paths
+
+
+def get_image_paths(category, folder_index):
+    image_paths = []
+    mapping = {
+        "早读": ["早读"],
+        "午休": ["午休"],
+        "课间": ["课间", "通用"],
+        "课间操": ["课间操", "通用"],
+        "放学": ["放学", "通用"],
+    }
+    if category in mapping.keys():
+        folders = mapping.get(category)
+        image_paths.extend(get_image_paths_from_folders(folders, folder_index))
+    else:
+        if re.match(r"\d-\d", category):
+            image_path = folder_index.find("课程", category)
+            if image_path is None:
+                image_path = os.path.join(folder_index.image_root, "课程", category + ".JPG")
+            image_paths.append(image_path)
+            image_paths.extend(get_image_paths_from_folders(["班级文化"], folder_index))
+    return image_paths
+
+
+def build(args, digest_cache=None, filelist=None, folder_index=None, phash_cache=None):
+    """
+    Build one task package from parsed build arguments
+    """
+    startdate = time.strptime("2021-03-15", "%Y-%m-%d")
+    stopdate = time.strptime("2022-04-30", "%Y-%m-%d")
+    taskname = time.strftime("%Y%m%d%H%M%S")
+    if args.name:
+        taskname = args.name
+    if args.start:
+        startdate = time.strptime(args.start, "%Y-%m-%d")
+    if args.stop:
+        stopdate = time.strptime(args.stop, "%Y-%m-%d")
+
+    if folder_index is None:
+        folder_index = folders.FolderIndex(args.images)
+    # 同一次生成中共享的图片（如班级文化）只查一次摘要
+    digest_cache = cache.MemoryDigestCache(parent=digest_cache)
+
+    materializer = materialize.Materializer(args.link_mode)
+    incremental = args.incremental or args.plan
+    tasklist = core.TaskList(taskname, startdate=startdate, stopdate=stopdate,
+                             digest_cache=digest_cache, materializer=materializer, stable_ids=incremental)
+    tasklist.verbose = not args.quiet
+    tasklist.hash_workers = args.hash_workers
+    tasklist.file_stats = folder_index.stats
+    if args.store:
+        tasklist.asset_store = store.AssetStore(args.store, link_mode=args.store_link, materializer=materializer)
+    if filelist is None:
+        tasklist.load_filelist(os.path.join(args.contents, "filelist.xml"))
+    else:
+        tasklist.set_filelist(filelist)
+
+    programs = {}
+    class_image_paths = get_image_paths_from_folders(["课程"], folder_index)
+    with instrument.stage("schedule"):
+        timetable = sched.load_timetable(args.timetable, args.timetable_name)
+        schedules = sched.calc_class_schedule_from_images(class_image_paths, timetable)
+    for schedule in schedules:
+        category, week_days, instance, starttime, stoptime, minutes = schedule
+        if category in ["早读", "课间", "课间操", "午休", "放学"]:
+            program_name = category
+            if program_name not in programs:
+                image_paths = get_image_paths(program_name, folder_index)
+                programs[program_name] = tasklist.create_program(program_name, image_paths=image_paths)
+            program = programs[program_name]
+        elif category == "课程":
+            program_name = "周{}第{}节".format("一二三四五"[week_days[0]], "零一二三四五六七八"[instance])
+            if program_name not in programs:
+                image_category = "{}-{}".format(week_days[0] + 1, instance)
+                image_paths = get_image_paths(image_category, folder_index)
+                programs[program_name] = tasklist.create_program(program_name, image_paths=image_paths)
+            program = programs[program_name]
+        tasklist.add_schedule(program, starttime=starttime, stoptime=stoptime, week_days=week_days, minutes=minutes)
+
+    overlaps = tasklist.find_overlaps()
+    for week_day, first, second in overlaps:
+        print("warning: 周{} {}-{} {} overlaps {}-{} {}".format(
+            "一二三四五六日"[week_day], first[0], first[1], "/".join(first[2]), second[0], second[1], "/".join(second[2])),
+            file=sys.stderr)
+    if overlaps and args.strict:
+        raise ValueError("{} overlapping schedules in {}".format(len(overlaps), taskname))
+
+    if args.near_duplicates:
+        canonical = find_near_duplicates(tasklist, args, phash_cache)
+        for name, kept in sorted(canonical.items()):
+            if args.near_duplicates == "flag" or not args.quiet:
+                print("near-duplicate: {} looks like {}".format(name, kept), file=sys.stderr)
+        if args.near_duplicates == "collapse":
+            tasklist.collapse_images(canonical)
+
+    if not args.no_prune:
+        pruned, pruned_bytes = tasklist.prune_filelist()
+        if not args.quiet:
+            print("pruned: {} unreferenced files, {:.1f} MB".format(pruned, pruned_bytes / 1048576))
+
+    if args.normalize:
+        tasklist.hash_filelist()
+        normalizer = create_normalizer(args)
+        normalizer.normalize(tasklist.filelist)
+        if not args.quiet:
+            print(normalizer.summary())
+
+    tasklist.consolidate()
+    previous = None
+    if incremental:
+        previous = manifest.load_manifest(tasklist.get_task_dir())
+    if args.plan:
+        _, _, diff = tasklist.plan(previous)
+        print(manifest.format_plan(diff))
+    elif args.archive:
+        archive.write_archive(tasklist, args.archive, args.archive_format)
+    else:
+        tasklist.save(previous, echo_xml=args.echo_xml)
+        if not args.quiet:
+            print(materializer.summary())
+            if tasklist.asset_store is not None:
+                print(tasklist.asset_store.summary())
+    return tasklist
+
+
+def find_near_duplicates(tasklist, args, phash_cache=None):
+    images = tasklist.get_referenced_images()
+    close_cache = phash_cache is None and not args.no_cache
+    if close_cache:
+        phash_cache = dedup.PerceptualHashCache()
+    try:
+        hashes = dedup.get_hashes(images, cache=phash_cache, workers=args.hash_workers)
+    finally:
+        if close_cache:
+            phash_cache.close()
+    return dedup.find_near_duplicates(images, hashes, args.near_duplicate_distance)
+
+
+def create_normalizer(args):
+    return normalize.Normalizer(args.normalize_dir, quality=args.quality, strip_metadata=not args.keep_metadata)
+
+
+def add_build_arguments(parser):
+    parser.add_argument ("--images", default="images", help="图片目录")
+    parser.add_argument ("--contents", default="Contents", help="素材库目录，包含filelist.xml和Files")
+    parser.add_argument ("--timetable", help="作息时间表文件（JSON或TOML），默认使用内置时间表")
+    parser.add_argument ("--timetable-name", help="时间表文件中的时间表名称，如 学校/学期")
+    parser.add_argument ("--strict", action="store_true", help="节目时间有重叠时报错")
+    parser.add_argument ("--no-cache", action="store_true", help="不使用文件摘要缓存")
+    parser.add_argument ("--incremental", action="store_true", help="增量生成，只重写有变化的文件")
+    parser.add_argument ("--plan", action="store_true", help="只显示增量生成将要修改的文件")
+    parser.add_argument ("-q", "--quiet", action="store_true", help="不输出处理过程信息")
+    parser.add_argument ("--echo-xml", action="store_true", help="将生成的XML输出到标准输出")
+    parser.add_argument ("--hash-workers", type=positive_int, default=None, help="计算文件摘要的线程数")
+    parser.add_argument ("--link-mode", choices=materialize.MODES, default="auto", help="素材文件生成方式")
+    parser.add_argument ("--archive-format", choices=archive.FORMATS, help="归档格式，默认按文件扩展名判断")
+    parser.add_argument ("--store", nargs="?", const=store.DEFAULT_STORE_PATH, help="使用按内容寻址的共享素材库")
+    parser.add_argument ("--store-link", choices=store.LINK_MODES, default="hardlink", help="任务目录引用共享素材库的方式")
+    parser.add_argument ("--near-duplicates", choices=dedup.MODES, help="检测看起来相同的图片：flag只提示，collapse只保留一张")
+    parser.add_argument ("--near-duplicate-distance", type=int, default=dedup.DEFAULT_DISTANCE, help="感知哈希允许的不同位数")
+    parser.add_argument ("--normalize", action="store_true", help="将图片缩放到1080x1920并重新编码（需要Pillow）")
+    parser.add_argument ("--quality", type=int, default=normalize.DEFAULT_QUALITY, help="重新编码的JPEG质量")
+    parser.add_argument ("--keep-metadata", action="store_true", help="重新编码时保留EXIF等元数据")
+    parser.add_argument ("--normalize-dir", default=normalize.DEFAULT_CACHE_PATH, help="缩放后图片的缓存目录")
+    parser.add_argument ("--no-prune", action="store_true", help="保留素材库中没有节目使用的文件")
+
+
+def add_arguments(parser):
+    parser.add_argument ("-n", "--name", help="班牌名称")
+    parser.add_argument ("--start", help="起始日期")
+    parser.add_argument ("--stop", help="结束日期")
+    parser.add_argument ("--profile", metavar="TRACE_JSON", help="记录各阶段耗时和I/O，写入trace event文件并输出汇总")
+    parser.add_argument ("--cprofile", metavar="STATS_FILE", help="用cProfile记录并写入pstats文件")
+    parser.add_argument ("--archive", metavar="PATH", help="直接生成zip或tar归档，'-'表示输出到标准输出")
+    add_build_arguments(parser)
+
+
+def main(args):
+    if args.archive == "-":
+        # 标准输出留给归档数据
+        args.quiet = True
+        args.echo_xml = False
+    digest_cache = None
+    if not args.no_cache:
+        digest_cache = cache.DigestCache()
+
+    profiler = None
+    if args.profile:
+        instrument.RECORDER.enable()
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        with instrument.stage("build"):
+            build(args, digest_cache=digest_cache)
+    finally:
+        # 生成失败时也保留已经算出的摘要
+        if digest_cache is not None:
+            digest_cache.close()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+    if digest_cache is not None and not args.quiet:
+        print(digest_cache.summary())
+    if args.profile:
+        instrument.RECORDER.save(args.profile)
+        print(instrument.RECORDER.summary(), file=sys.stderr)
+    return 0
+
+
+def load_boards(board_file):
+    with open(board_file, "r", encoding="utf-8") as f:
+        boards = json.load(f)
+    if isinstance(boards, dict):
+        boards = boards["boards"]
+    for board in boards:
+        if not board.get("name"):
+            raise ValueError("Every board in {} needs a name".format(board_file))
+    return boards
+
+
+def get_board_args(args, board):
+    board_args = argparse.Namespace(**vars(args))
+    board_args.name = board["name"]
+    board_args.images = board.get("images", args.images)
+    board_args.start = board.get("start", args.start)
+    board_args.stop = board.get("stop", args.stop)
+    board_args.timetable = board.get("timetable", args.timetable)
+    board_args.timetable_name = board.get("timetable_name", args.timetable_name)
+    # 使用稳定ID，避免重复生成时产生不同的任务目录
+    board_args.incremental = True
+    return board_args
+
+
+def copy_filelist(filelist):
+    # 记录不会被修改，各看板只需要自己的字典
+    return dict(filelist)
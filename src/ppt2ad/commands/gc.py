@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+gc subcommand: remove unreferenced blobs from the shared asset store
+'''
+
+from .. import store
+
+
+def add_arguments(parser):
+    parser.add_argument ("task_dirs", nargs="*", help="仍在使用的任务目录，默认为当前目录下所有含manifest.json的目录")
+    parser.add_argument ("--store", default=store.DEFAULT_STORE_PATH, help="共享素材库目录")
+    parser.add_argument ("--root", default=".", help="查找任务目录的位置")
+    parser.add_argument ("--dry-run", action="store_true", help="只统计，不删除")
+
+
+def main(args):
+    asset_store = store.AssetStore(args.store)
+    task_dirs = args.task_dirs or store.find_task_dirs(args.root)
+    removed, freed = asset_store.gc(task_dirs, dry_run=args.dry_run)
+    action = "would remove" if args.dry_run else "removed"
+    print("{} task directories, {} {} blobs, {:.1f} MB freed".format(len(task_dirs), action, removed, freed / 1048576))
+    return 0
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+publish subcommand: upload task directories
+'''
+
+import asyncio
+
+from .. import publish
+from .. import store
+from . import positive_int
+
+
+def add_arguments(parser):
+    parser.add_argument ("task_dirs", nargs="*", help="任务目录，默认为当前目录下所有含manifest.json的目录")
+    parser.add_argument ("--endpoint", required=True, help="上传地址，如 http://server:8080/tasks")
+    parser.add_argument ("--root", default=".", help="查找任务目录的位置")
+    parser.add_argument ("-j", "--jobs", type=positive_int, default=8, help="同时上传的文件数")
+    parser.add_argument ("--connections", type=positive_int, default=8, help="HTTP连接数")
+    parser.add_argument ("--retries", type=int, default=5, help="失败重试次数")
+    parser.add_argument ("--chunk-size", type=int, default=publish.CHUNK_SIZE // 1024, help="分块大小（KB）")
+
+
+def main(args):
+    task_dirs = args.task_dirs or store.find_task_dirs(args.root)
+    publisher, results = asyncio.run(publish.publish_task_dirs(
+        task_dirs, args.endpoint, jobs=args.jobs, connections=args.connections,
+        retries=args.retries, chunk_size=args.chunk_size * 1024))
+    failed = 0
+    for task_dir, error in results.items():
+        if error is None:
+            print("OK     {}".format(task_dir))
+        else:
+            failed += 1
+            print("FAILED {}: {}".format(task_dir, error))
+    print(publisher.summary())
+    return 1 if failed else 0
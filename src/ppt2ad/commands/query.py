@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+query subcommand: what a generated task plays and when
+'''
+
+import argparse
+import datetime
+import json
+import sys
+
+from .. import playback
+
+
+def parse_datetime(text):
+    for time_format in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return datetime.datetime.strptime(text, time_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date and time: {}".format(text))
+
+
+def add_arguments(parser):
+    parser.add_argument ("task_dirs", nargs="+", help="任务目录")
+    parser.add_argument ("--at", type=parse_datetime, help="查询某一时刻，如 '2021-03-15 08:10'")
+    parser.add_argument ("--range", nargs=2, type=parse_datetime, metavar=("FROM", "TO"), help="查询时间段")
+    parser.add_argument ("--coverage", action="store_true", help="输出整个学期的空档和各节目播放时长（默认）")
+    parser.add_argument ("--json", action="store_true", help="以JSON格式输出")
+
+
+def main(args):
+    results = {}
+    for task_dir in args.task_dirs:
+        calendar = playback.PlaybackCalendar.from_task_dir(task_dir)
+        result = {}
+        if args.at:
+            result["at"] = calendar.at(args.at)
+        if args.range:
+            result["between"] = [(start.isoformat(sep=" "), stop.isoformat(sep=" "), names)
+                                 for start, stop, names in calendar.between(*args.range)]
+        if args.coverage or not (args.at or args.range):
+            result["coverage"] = calendar.coverage()
+        results[task_dir] = result
+
+    if args.json:
+        json.dump(results, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return 0
+    for task_dir, result in results.items():
+        if len(results) > 1:
+            print("== {}".format(task_dir))
+        if "at" in result:
+            print("{}: {}".format(args.at, "/".join(result["at"]) or "-"))
+        for start, stop, names in result.get("between", []):
+            print("{} - {} {}".format(start, stop, "/".join(names)))
+        if "coverage" in result:
+            print(playback.format_coverage(result["coverage"]))
+    return 0
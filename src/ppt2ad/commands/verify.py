@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+verify subcommand: check generated task packages
+'''
+
+import json
+import sys
+
+from .. import store
+from .. import verify
+from . import positive_int
+
+
+def add_arguments(parser):
+    parser.add_argument ("task_dirs", nargs="*", help="任务目录，默认为当前目录下所有含manifest.json的目录")
+    parser.add_argument ("--root", default=".", help="查找任务目录的位置")
+    parser.add_argument ("-j", "--jobs", type=positive_int, default=None, help="同时校验的任务包数")
+    parser.add_argument ("--hash-workers", type=positive_int, default=None, help="计算校验和的线程数")
+    parser.add_argument ("--json", action="store_true", help="以JSON格式输出报告")
+    parser.add_argument ("-q", "--quiet", action="store_true", help="只输出有问题的任务包")
+
+
+def main(args):
+    task_dirs = args.task_dirs or store.find_task_dirs(args.root)
+    reports = verify.verify_packages(task_dirs, jobs=args.jobs, hash_workers=args.hash_workers)
+    failed = sum(1 for report in reports if report.problems)
+    if args.json:
+        json.dump({"packages": len(reports), "failed": failed, "reports": [report.to_dict() for report in reports]},
+                  sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        for report in reports:
+            if report.problems or not args.quiet:
+                print(verify.format_report(report))
+        print("{} packages, {} failed".format(len(reports), failed))
+    return 1 if failed else 0
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+watch subcommand: rebuild boards when their images or the library change
+'''
+
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from .. import cache
+from .. import core
+from .. import folders
+from .. import watch
+from . import build
+
+
+def add_arguments(parser):
+    parser.add_argument ("-n", "--name", help="班牌名称")
+    parser.add_argument ("--boards", help="班牌列表JSON文件，同时监视多个班牌")
+    parser.add_argument ("--start", help="起始日期")
+    parser.add_argument ("--stop", help="结束日期")
+    parser.add_argument ("--debounce", type=float, default=0.3, help="变化停止多少秒后再重新生成")
+    parser.add_argument ("--poll", action="store_true", help="不使用inotify，定时检查文件状态")
+    parser.add_argument ("--poll-interval", type=float, default=1.0, help="定时检查的间隔秒数")
+    build.add_build_arguments(parser)
+
+
+def is_below(path, root):
+    relpath = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    return not relpath.startswith(os.pardir)
+
+
+def main(args):
+    if args.boards:
+        boards = build.load_boards(args.boards)
+    elif args.name:
+        boards = [{"name": args.name}]
+    else:
+        print("watch needs --name or --boards", file=sys.stderr)
+        return 2
+    all_board_args = [build.get_board_args(args, board) for board in boards]
+    for board_args in all_board_args:
+        board_args.quiet = len(boards) > 1 or args.quiet
+        board_args.echo_xml = False
+        board_args.plan = False
+        board_args.archive = None
+
+    digest_cache = None
+    if not args.no_cache:
+        digest_cache = cache.DigestCache()
+    # 素材库、目录索引和摘要常驻内存，文件变化时只更新变化的部分
+    memory_cache = cache.MemoryDigestCache(parent=digest_cache)
+    filelist_path = os.path.join(args.contents, "filelist.xml")
+    state = {"filelist": core.load_filelist(filelist_path)}
+    folder_indexes = {}
+    for board_args in all_board_args:
+        if board_args.images not in folder_indexes:
+            folder_indexes[board_args.images] = folders.FolderIndex(board_args.images)
+
+    def rebuild_boards(selected):
+        for board_args in selected:
+            start = time.perf_counter()
+            filelist = build.copy_filelist(state["filelist"])
+            try:
+                tasklist = build.build(board_args, digest_cache=memory_cache, filelist=filelist,
+                                 folder_index=folder_indexes[board_args.images])
+            except Exception as e:
+                print("FAILED {}: {}".format(board_args.name, e))
+            else:
+                print("OK     {} -> {} ({:.2f}s)".format(
+                    board_args.name, tasklist.get_task_dir(), time.perf_counter() - start))
+        memory_cache.flush()
+        sys.stdout.flush()
+
+    def on_change(changed):
+        memory_cache.invalidate(changed)
+        touched = set(image_root for image_root, folder_index in folder_indexes.items()
+                      if folder_index.update(changed))
+        if any(is_below(path, args.contents) for path in changed):
+            try:
+                state["filelist"] = core.load_filelist(filelist_path)
+            except (OSError, ET.ParseError) as e:
+                # 文件可能正在写入，等待下一次变化
+                print("FAILED {}: {}".format(filelist_path, e))
+                return
+            selected = all_board_args
+        else:
+            selected = [board_args for board_args in all_board_args if board_args.images in touched]
+        if selected:
+            print("{} files changed, rebuilding {} boards".format(len(changed), len(selected)))
+            rebuild_boards(selected)
+
+    rebuild_boards(all_board_args)
+    roots = sorted(folder_indexes) + [args.contents]
+    print("watching {}".format(", ".join(roots)))
+    sys.stdout.flush()
+    try:
+        watch.watch(roots, on_change, debounce=args.debounce, poll_interval=args.poll_interval,
+                    use_inotify=not args.poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        memory_cache.close()
+    return 0
@@ -9,17 +9,29 @@ Author: Jeff Li <lijinfeng01@inspur.com>
 Date: 2021/03/21 13:24:08
 '''
 
+import bisect
+import concurrent.futures
 import datetime
 import hashlib
 import math
 import os
+import sys
 import time
+import weakref
 import xml.etree.ElementTree as ET
 
+from . import fragments
 from . import helper_xml
+from . import instrument
+from . import manifest
+from . import materialize
 
 
 LAST_ID = 0
+CHUNK_SIZE = 1024 * 1024
+HEAD_SIZE = 64 * 1024
+
+XML_DOCUMENTS = manifest.XML_DOCUMENTS
 
 
 def create_id():
@@ -31,56 +43,367 @@ def create_id():
     return str(LAST_ID)
 
 
-def get_file_digest(file_path):
+def create_stable_id(*parts):
+    """
+    Derive a 10-digit id from its parts, so rebuilds keep the same ids
+    """
+    digest = hashlib.md5("/".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return str(1000000000 + int(digest[:15], 16) % 9000000000)
+
+
+def compute_file_digest(file_path):
     with open(file_path, "rb") as image:
         hasher = hashlib.md5()
-        hasher.update(image.read())
+        for chunk in iter(lambda: image.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+            instrument.count("bytes_read", len(chunk))
+        instrument.count("digests")
         return hasher.hexdigest()
 
 
+def get_xml_digest(root):
+    writer = helper_xml.HashWriter(hashlib.md5())
+    helper_xml.write_xml(root, writer)
+    return writer.hexdigest()
+
+
+def get_file_digest(file_path, cache=None):
+    if cache is None:
+        return compute_file_digest(file_path)
+    return cache.get(file_path, compute_file_digest)
+
+
+def get_file_digests(file_paths, cache=None, workers=None, stats=None):
+    """
+    Digest a batch of files on a bounded thread pool
+
+    Every path is hashed at most once; cache lookups and stores stay on the
+    calling thread. Known stat results can be passed in stats to save the
+    cache a stat call per file.
+    """
+    if stats is None:
+        stats = {}
+    digests = {}
+    missing = []
+    for file_path in file_paths:
+        if file_path in digests:
+            continue
+        digest = None
+        if cache is not None:
+            digest = cache.lookup(file_path, stat=stats.get(file_path))
+        digests[file_path] = digest
+        if digest is None:
+            missing.append(file_path)
+    if len(missing) == 1 or workers == 1:
+        computed = [compute_file_digest(file_path) for file_path in missing]
+    elif missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            computed = list(executor.map(compute_file_digest, missing))
+    else:
+        computed = []
+    for file_path, digest in zip(missing, computed):
+        digests[file_path] = digest
+        if cache is not None:
+            cache.store(file_path, digest)
+    return digests
+
+
+def compute_head_digest(file_path):
+    with open(file_path, "rb") as image:
+        head = image.read(HEAD_SIZE)
+    instrument.count("bytes_read", len(head))
+    return hashlib.md5(head).hexdigest()
+
+
+class Asset:
+    """
+    One filelist record
+
+    name, path, size and crc never change once created; use replace() for
+    a record pointing at other content.  digest and head are filled in
+    lazily and only depend on the content, so records can be shared by
+    every board of a batch.
+    """
+    __slots__ = ("name", "path", "size", "crc", "digest", "head")
+
+    def __init__(self, name, path, size, crc, digest=None):
+        self.name = sys.intern(name)
+        self.path = path
+        self.size = size
+        self.crc = crc
+        self.digest = digest
+        self.head = None
+
+    def replace(self, **changes):
+        fields = {"name": self.name, "path": self.path, "size": self.size, "crc": self.crc, "digest": self.digest}
+        fields.update(changes)
+        return Asset(**fields)
+
+    def __repr__(self):
+        return "Asset({!r}, {!r})".format(self.name, self.path)
+
+
+class ImageEntry:
+    """
+    One use of an asset in an imagerect, under the name of its source file
+
+    Entries are never modified, so get() hands out one shared entry per
+    name and source file name while any program still uses it.
+    """
+    __slots__ = ("name", "orig_name", "__weakref__")
+    # 弱引用，watch长期运行时不会保留已丢弃任务的条目
+    entries = weakref.WeakValueDictionary()
+
+    def __init__(self, name, orig_name):
+        self.name = name
+        self.orig_name = orig_name
+
+    @classmethod
+    def get(cls, name, orig_name):
+        entry = cls.entries.get((name, orig_name))
+        if entry is None:
+            entry = cls(sys.intern(name), sys.intern(orig_name))
+            cls.entries[(entry.name, entry.orig_name)] = entry
+        return entry
+
+    def __repr__(self):
+        return "ImageEntry({!r}, {!r})".format(self.name, self.orig_name)
+
+
+def load_filelist(xml_path):
+    """
+    Read filelist.xml into records keyed by name, without hashing any file
+    """
+    tree = ET.parse(xml_path)
+    files_dir = os.path.join(os.path.dirname(xml_path), "Files")
+    filelist = {}
+    for file_elm in tree.findall("*/file"):
+        image_file = Asset(file_elm.get("name"), os.path.join(files_dir, file_elm.get("name")),
+                           file_elm.get("size"), file_elm.get("crc"))
+        filelist[image_file.name] = image_file
+    return filelist
+
+
+class SizeIndex:
+    """
+    Filelist records bucketed by the size attribute from filelist.xml
+
+    Records whose attribute is missing or stale can still be found through
+    the on-disk sizes, which are only looked up when a source has no match.
+    """
+    def __init__(self, filelist):
+        self.filelist = filelist
+        self.by_size = {}
+        self.by_stat = None
+        for image_file in filelist.values():
+            try:
+                size = int(image_file.size)
+            except (TypeError, ValueError):
+                size = None
+            self.by_size.setdefault(size, []).append(image_file)
+
+    def get(self, size):
+        return self.by_size.get(size, [])
+
+    def get_on_disk(self, size):
+        if self.by_stat is None:
+            self.by_stat = {}
+            for image_file in self.filelist.values():
+                self.by_stat.setdefault(os.path.getsize(image_file.path), []).append(image_file)
+        return self.by_stat.get(size, [])
+
+
+def match_files(file_paths, size_index, cache=None, workers=None, stats=None):
+    """
+    Find the filelist record holding the same content as each source file
+
+    Only records whose size equals a source's size are considered. When
+    several records share that size they are narrowed down by the digest of
+    their first HEAD_SIZE bytes before full digests are computed, and each
+    record is hashed at most once. Sources without a match are left out.
+    """
+    if stats is None:
+        stats = {}
+    sizes = {}
+    for file_path in file_paths:
+        stat = stats.get(file_path)
+        sizes[file_path] = os.path.getsize(file_path) if stat is None else stat.st_size
+    matches, digests = _match_buckets(sizes, size_index.get, cache, workers, stats)
+    unmatched = {file_path: size for file_path, size in sizes.items() if file_path not in matches}
+    if unmatched:
+        more_matches, more_digests = _match_buckets(unmatched, size_index.get_on_disk, cache, workers, stats)
+        matches.update(more_matches)
+        digests.update(more_digests)
+    return matches, digests
+
+
+def _match_buckets(sizes, get_bucket, cache, workers, stats):
+    candidates = {}
+    for file_path, size in sizes.items():
+        bucket = get_bucket(size)
+        if len(bucket) > 1:
+            head = compute_head_digest(file_path)
+            for image_file in bucket:
+                if image_file.digest is None and image_file.head is None:
+                    image_file.head = compute_head_digest(image_file.path)
+            bucket = [image_file for image_file in bucket
+                      if image_file.digest is not None or image_file.head == head]
+        candidates[file_path] = bucket
+
+    paths = list(candidates)
+    for bucket in candidates.values():
+        paths.extend(image_file.path for image_file in bucket if image_file.digest is None)
+    digests = get_file_digests(paths, cache=cache, workers=workers, stats=stats)
+
+    matches = {}
+    for file_path, bucket in candidates.items():
+        for image_file in bucket:
+            if image_file.digest is None:
+                image_file.digest = digests[image_file.path]
+            if image_file.digest == digests[file_path] and file_path not in matches:
+                matches[file_path] = image_file
+    return matches, digests
+
+
+def hash_records(records, cache=None, workers=None):
+    """
+    Fill in the digests of filelist records that were never hashed
+    """
+    pending = [file_info for file_info in records if file_info.digest is None]
+    digests = get_file_digests([file_info.path for file_info in pending], cache=cache, workers=workers)
+    for file_info in pending:
+        file_info.digest = digests[file_info.path]
+
+
+def get_file_size(image_file):
+    try:
+        return int(image_file.size)
+    except (TypeError, ValueError):
+        return os.path.getsize(image_file.path)
+
+
+def get_file_signature(image_file):
+    """
+    Digest of a filelist record, or its size and mtime when it was never hashed
+    """
+    if image_file.digest is not None:
+        return image_file.digest
+    stat = os.stat(image_file.path)
+    return "stat:{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+
 class TaskList:
-    def __init__(self, name, startdate, stopdate):
-        self.taskid = create_id()
+    def __init__(self, name, startdate, stopdate, digest_cache=None, materializer=None, stable_ids=False):
+        self.stable_ids = stable_ids
+        if stable_ids:
+            self.taskid = create_stable_id("task", name)
+        else:
+            self.taskid = create_id()
         self.taskname = name
         self.tasktype = "loop"
         self.ver = ""
         self.filelist = {}
+        self.size_index = SizeIndex({})
         self.programlist = []
+        self.inputs = {}
+        self.schedules = []
         self.multi_task = MultiTask(0, startdate, stopdate)
         self.startdate = startdate
         self.stopdate = stopdate
         self.version = time.strftime("%Y%m%d %H%M%S")
+        self.digest_cache = digest_cache
+        self.verbose = True
+        self.hash_workers = None
+        self.file_stats = {}
+        self.asset_store = None
+        self.fragment_cache = fragments.FRAGMENT_CACHE
+        if materializer is None:
+            materializer = materialize.Materializer()
+        self.materializer = materializer
+
+    def get_task_dir(self):
+        return str(self.taskid)
+
+    def render(self):
+        documents = {
+            "tasklist.xml": self.create_tasklist_xml(),
+            "filelist.xml": self.create_filelist_xml(),
+            "playlist.xml": self.create_playlist_xml(self.fragment_cache),
+            "tacticlist.xml": self.create_tacticlist_xml(),
+        }
+        return {name: documents[name] for name in XML_DOCUMENTS}
 
-    def save(self):
-        root_dir = os.path.join(str(self.taskid), "Contents")
-        os.makedirs(root_dir, exist_ok=True)
-        tree = self.create_tasklist_xml()
-        content = helper_xml.prettify_xml(tree)
-        print(content)
-        with open(os.path.join(root_dir, "tasklist.xml"), "w") as xml_file:
-            xml_file.write(content)
-        tree = self.create_filelist_xml()
-        content = helper_xml.prettify_xml(tree)
-        print(content)
-        with open(os.path.join(root_dir, "filelist.xml"), "w") as xml_file:
-            xml_file.write(content)
-        tree = self.create_playlist_xml()
-        content = helper_xml.prettify_xml(tree)
-        print(content)
-        with open(os.path.join(root_dir, "playlist.xml"), "w") as xml_file:
-            xml_file.write(content)
-        tree = self.create_tacticlist_xml()
-        content = helper_xml.prettify_xml(tree)
-        print(content)
-        with open(os.path.join(root_dir, "tacticlist.xml"), "w") as xml_file:
-            xml_file.write(content)
-
-        img_dir = os.path.join(root_dir, "Files")
-        os.makedirs(img_dir, exist_ok=True)
-        for file_info in self.filelist.values():
-            file_path = os.path.join(img_dir, file_info["name"])
-            with open(file_path, "wb") as image_file:
-                image_file.write(file_info["data"])
+    def create_manifest(self, documents):
+        return {
+            "taskid": self.taskid,
+            "taskname": self.taskname,
+            "version": self.version,
+            "inputs": dict(self.inputs),
+            "schedule": list(self.schedules),
+            "files": {file_info.name: get_file_signature(file_info) for file_info in self.filelist.values()},
+            "xml": {name: get_xml_digest(root) for name, root in documents.items()},
+        }
+
+    def plan(self, previous=None):
+        """
+        Render all documents and compare them against the previous manifest
+
+        The previous version is kept when nothing changed, so that an
+        unchanged task produces byte-identical documents.
+        """
+        with instrument.stage("plan"):
+            if previous is not None:
+                self.version = previous["version"]
+                documents = self.render()
+                current = self.create_manifest(documents)
+                diff = manifest.diff_manifest(previous, current)
+                if manifest.is_unchanged(diff):
+                    return documents, current, diff
+                self.consolidate()
+            documents = self.render()
+            current = self.create_manifest(documents)
+            diff = manifest.diff_manifest(previous, current)
+            return documents, current, diff
+
+    def save(self, previous=None, echo_xml=False):
+        with instrument.stage("save"):
+            if self.asset_store is not None:
+                self.hash_filelist()
+            documents, current, diff = self.plan(previous)
+            task_dir = self.get_task_dir()
+            root_dir = os.path.join(task_dir, "Contents")
+            os.makedirs(root_dir, exist_ok=True)
+            with instrument.stage("write_xml"):
+                for name, root in documents.items():
+                    xml_path = os.path.join(root_dir, name)
+                    if name not in diff["xml"] and os.path.exists(xml_path):
+                        continue
+                    with open(xml_path, "wb") as xml_file:
+                        helper_xml.write_xml(root, xml_file)
+                        instrument.count("bytes_written", xml_file.tell())
+                    if echo_xml:
+                        sys.stdout.flush()
+                        helper_xml.write_xml(root, sys.stdout.buffer)
+                        sys.stdout.buffer.flush()
+
+            with instrument.stage("materialize"):
+                img_dir = os.path.join(root_dir, "Files")
+                os.makedirs(img_dir, exist_ok=True)
+                for file_info in self.filelist.values():
+                    file_path = os.path.join(img_dir, file_info.name)
+                    if file_info.name not in diff["files"] and os.path.exists(file_path):
+                        continue
+                    if self.asset_store is not None:
+                        self.asset_store.place(file_info.path, file_info.digest, file_path)
+                    else:
+                        self.materializer.materialize(file_info.path, file_path)
+                for name in diff["removed"]:
+                    file_path = os.path.join(img_dir, name)
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+
+            manifest.save_manifest(task_dir, current)
+            return diff
 
     def create_tasklist_xml(self):
         root = ET.Element("config")
@@ -93,38 +416,88 @@ class TaskList:
         self.version = time.strftime("%Y%m%d %H%M%S")
 
     def load_filelist(self, xml_path):
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-        file_elms = tree.findall("*/file")
-        self.filelist.clear()
-        for file_elm in tree.findall("*/file"):
-            image_file = {
-                "crc": file_elm.get("crc"),
-                "name": file_elm.get("name"),
-                "size": file_elm.get("size"),
-            }
-            image_path = os.path.join("Contents", "Files", image_file["name"])
-            with open(image_path, "rb") as f:
-                image_file["data"] = f.read()
-            digest = get_file_digest(image_path)
-            self.filelist[digest] = image_file
+        with instrument.stage("load_filelist"):
+            self.set_filelist(load_filelist(xml_path))
+
+    def hash_filelist(self):
+        """
+        Compute the digests of filelist records that were never matched
+        """
+        hash_records(self.filelist.values(), cache=self.digest_cache, workers=self.hash_workers)
+
+    def get_referenced_images(self):
+        """
+        Filelist records shown by any program, in order of first use
+        """
+        names = {}
+        for program in self.programlist:
+            for imagerect in program.imagerects:
+                for entry in imagerect.img_list:
+                    names.setdefault(entry.name)
+        return [self.filelist[name] for name in names]
+
+    def prune_filelist(self):
+        """
+        Drop the filelist records no program shows, returning how many
+        were dropped and their total size
+        """
+        referenced = set(file_info.name for file_info in self.get_referenced_images())
+        removed = [file_info for name, file_info in self.filelist.items() if name not in referenced]
+        self.set_filelist({name: file_info for name, file_info in self.filelist.items() if name in referenced})
+        return len(removed), sum(get_file_size(file_info) for file_info in removed)
+
+    def collapse_images(self, canonical):
+        """
+        Show the kept record in place of each near-duplicate, and drop the
+        near-duplicates from the filelist
+        """
+        for program in self.programlist:
+            for imagerect in program.imagerects:
+                imagerect.img_list[:] = [ImageEntry.get(canonical[entry.name], entry.orig_name)
+                                         if entry.name in canonical else entry for entry in imagerect.img_list]
+        for name in canonical:
+            self.filelist.pop(name, None)
+        self.size_index = SizeIndex(self.filelist)
+
+    def set_filelist(self, filelist):
+        self.filelist = filelist
+        self.size_index = SizeIndex(filelist)
+
+    def replace_asset(self, name, **changes):
+        """
+        Point a filelist record at other content without touching the
+        record, which other boards may share
+        """
+        self.filelist[name] = self.filelist[name].replace(**changes)
 
     def create_program(self, name, image_paths):
-        program = Program(name)
-        self.programlist.append(program)
-        images = self.search_image(image_paths)
-        program.create_imagerect(images)
-        return program
+        with instrument.stage("create_program", program=name):
+            if self.stable_ids:
+                program = Program(name, program_id=create_stable_id(self.taskid, "program", name))
+            else:
+                program = Program(name)
+            self.programlist.append(program)
+            images = self.search_image(image_paths)
+            rectid = None
+            if self.stable_ids:
+                rectid = create_stable_id(program.program_id, "imagerect", len(program.imagerects))
+            program.create_imagerect(images, rectid=rectid)
+            return program
 
     def search_image(self, file_path_list):
-        images = []
-        for file_path in file_path_list:
-            digest = get_file_digest(file_path)
-            print(file_path)
-            image = self.filelist[digest]
-            image["orig_name"] = os.path.basename(file_path)
-            images.append(image)
-        return images
+        with instrument.stage("search_image", images=len(file_path_list)):
+            images = []
+            matches, digests = match_files(file_path_list, self.size_index, cache=self.digest_cache,
+                                           workers=self.hash_workers, stats=self.file_stats)
+            for file_path in file_path_list:
+                digest = digests[file_path]
+                self.inputs[file_path] = digest
+                if self.verbose:
+                    print(file_path)
+                if file_path not in matches:
+                    raise KeyError("No file in filelist matches {} ({})".format(file_path, digest))
+                images.append(ImageEntry.get(matches[file_path].name, os.path.basename(file_path)))
+            return images
 
     def add_schedule(self, program, starttime, week_days, stoptime=None, minutes=None):
         if stoptime is None:
@@ -137,8 +510,21 @@ class TaskList:
             delta = datetime.timedelta(seconds=1)
             stop = stop - delta
             stoptime = stop.strftime("%H:%M:%S")
+        self.schedules.append([program.name, starttime, stoptime, list(week_days)])
         self.multi_task.add_program(program, starttime, stoptime, week_days)
 
+    def find_overlaps(self):
+        """
+        Return (week_day, first, second) for programs scheduled at overlapping
+        times, each slot given as (starttime, stoptime, program names)
+        """
+        names = {program.program_id: program.name for program in self.programlist}
+
+        def describe(pro_serial):
+            return pro_serial.starttime, pro_serial.stoptime, [names.get(program_id, program_id) for program_id in pro_serial.program_ids]
+
+        return [(week_day, describe(first), describe(second)) for week_day, first, second in self.multi_task.find_overlaps()]
+
     def to_et(self):
         elm = ET.Element("tasklist")
         elm.set("taskid", self.taskid)
@@ -155,19 +541,29 @@ class TaskList:
         filelist.set("ver", self.version)
         for file_info in self.filelist.values():
             elm = ET.SubElement(filelist, "file")
-            elm.set("crc", file_info["crc"])
-            elm.set("name", file_info["name"])
-            elm.set("size", file_info["size"])
+            elm.set("crc", file_info.crc)
+            elm.set("name", file_info.name)
+            elm.set("size", file_info.size)
         return root
 
-    def create_playlist_xml(self):
+    def create_playlist_xml(self, fragment_cache=None):
+        """
+        playlist.xml with real <program> elements, or with fragment_cache
+        given, with placeholders that only helper_xml.write_xml renders
+
+        render() uses the placeholders, as its documents are only written
+        out and hashed.
+        """
         root = ET.Element("config")
         filelist = ET.SubElement(root, "programlist")
         filelist.set("taskid", self.taskid)
         filelist.set("taskname", self.taskname)
         filelist.set("ver", self.version)
         for program in self.programlist:
-            root.append(program.to_et())
+            if fragment_cache is None:
+                root.append(program.to_et())
+            else:
+                root.append(fragment_cache.get(program))
         elm = ET.SubElement(root, "meta")
         elm.append(ET.Element("files"))
         elm.append(ET.Element("fonts"))
@@ -186,82 +582,104 @@ class TaskList:
         return root
 
 
+# 所有节目都相同的属性只保存一份，None的位置由各对象填入
+PROGRAM_ATTRIBUTES = {
+    "height": "1920",
+    "id": None,
+    "name": None,
+    "state": "play",
+    "width": "1080",
+}
+IMAGERECT_ATTRIBUTES = {
+    "interactive": "off",
+    "jump": "0",
+    "layer": "1",
+    "nH": "1920",
+    "nW": "1080",
+    "nX": "0",
+    "nY": "0",
+    "rectid": None,
+    "rectname": "Image",
+}
+IMG_ATTRIBUTES = {
+    "cutin": "normal",
+    "effecttime": "2",
+    "name": None,
+    "path": None,
+    "position": "full",
+    "scroll": "normal",
+    "seq": None,
+    "showtime": "5",
+    "swap": "normal",
+}
+
+
 class Program:
-    def __init__(self, name):
-        self.program_id = create_id()
-        self.name = name
-        self.state = "play"
-        self.width = "1080"
-        self.height = "1920"
+    __slots__ = ("program_id", "name", "imagerects")
+
+    def __init__(self, name, program_id=None):
+        if program_id is None:
+            program_id = create_id()
+        self.program_id = program_id
+        self.name = sys.intern(name)
         self.imagerects = []
 
-    def create_imagerect(self, images):
-        imagerect = ImageRect()
+    def create_imagerect(self, images, rectid=None):
+        imagerect = ImageRect(rectid)
         imagerect.add_images(images)
         self.imagerects.append(imagerect)
         return imagerect
 
+    def get_attributes(self):
+        return dict(PROGRAM_ATTRIBUTES, id=self.program_id, name=self.name)
+
+    def get_fragment_key(self):
+        """
+        Everything to_et renders except the ids
+        """
+        attributes = self.get_attributes()
+        del attributes["id"]
+        return tuple(attributes.items()), tuple(imagerect.get_fragment_key() for imagerect in self.imagerects)
+
     def to_et(self):
-        attribute = {
-            "height": self.height,
-            "id": self.program_id,
-            "name": self.name,
-            "state": self.state,
-            "width": self.width,
-        }
-        elm = ET.Element("program", attrib=attribute)
+        elm = ET.Element("program", attrib=self.get_attributes())
         for imagerect in self.imagerects:
             elm.append(imagerect.to_et())
         return elm
 
 
 class ImageRect:
-    def __init__(self):
-        self.rectid = create_id()
-        self.rectname = "Image"
-        self.interactive = "off"
-        self.jump = "0"
-        self.layer = "1"
-        self.nH = "1920"
-        self.nW = "1080"
-        self.nX = "0"
-        self.nY = "0"
+    __slots__ = ("rectid", "img_list")
+
+    def __init__(self, rectid=None):
+        if rectid is None:
+            rectid = create_id()
+        self.rectid = rectid
         self.img_list = []
 
     def add_images(self, images):
         self.img_list.clear()
         self.img_list.extend(images)
 
+    def get_attributes(self):
+        return dict(IMAGERECT_ATTRIBUTES, rectid=self.rectid)
+
+    def get_fragment_key(self):
+        attributes = self.get_attributes()
+        del attributes["rectid"]
+        return tuple(attributes.items()), tuple((entry.orig_name, entry.name) for entry in self.img_list)
+
     def to_et(self):
-        attribute = {
-            "interactive": self.interactive,
-            "jump": self.jump,
-            "layer": self.layer,
-            "nH": self.nH,
-            "nW": self.nW,
-            "nX": self.nX,
-            "nY": self.nY,
-            "rectid": self.rectid,
-            "rectname": self.rectname,
-        }
-        elm = ET.Element("imagerect", attrib=attribute)
-        for index, file_info in enumerate(self.img_list):
-            attribute = {
-                "cutin": "normal",
-                "effecttime": "2",
-                "name": file_info["orig_name"],
-                "path": file_info["name"],
-                "position": "full",
-                "scroll": "normal",
-                "seq": str(index),
-                "showtime": "5",
-                "swap": "normal",
-            }
+        elm = ET.Element("imagerect", attrib=self.get_attributes())
+        for index, entry in enumerate(self.img_list):
+            attribute = dict(IMG_ATTRIBUTES, name=entry.orig_name, path=entry.name, seq=str(index))
             elm.append(ET.Element("img", attrib=attribute))
         return elm
 
 
 class MultiTask:
+    __slots__ = ("multi_task_id", "startdate", "stopdate", "day_tasks")
+
     def __init__(self, multi_task_id, startdate, stopdate):
         self.multi_task_id = multi_task_id
         self.startdate = startdate
@@ -269,11 +687,21 @@ class MultiTask:
         self.day_tasks = [DayTask(day_task_id=0, seq=index+1) for index in range(7)]
 
     def add_program(self, program, starttime, stoptime, week_days):
+        start_week_day = self.startdate.tm_wday
+        for week_day in sorted(set(week_days)):
+            self.day_tasks[(week_day - start_week_day) % 7].add_program(program, starttime, stoptime)
+
+    def find_overlaps(self):
+        """
+        Return (week_day, pro_serial, pro_serial) for overlapping time windows
+        """
+        overlaps = []
         start_week_day = self.startdate.tm_wday
         for index, day_task in enumerate(self.day_tasks):
             week_day = (start_week_day + index) % 7
-            if week_day in week_days:
-                day_task.add_program(program, starttime, stoptime)
+            for first, second in day_task.find_overlaps():
+                overlaps.append((week_day, first, second))
+        return overlaps
 
     def to_et(self):
         attribute = {
@@ -288,34 +716,54 @@ class MultiTask:
 
 
 class DayTask:
+    __slots__ = ("day_task_id", "seq", "pro_serial_list", "starttimes", "slots")
+
     def __init__(self, day_task_id, seq):
         self.day_task_id = day_task_id
         self.seq = seq
         self.pro_serial_list = []
+        self.starttimes = []
+        self.slots = {}
 
     def add_program(self, program, starttime, stoptime):
-        pro_serial = None
-        for pro_serial_temp in self.pro_serial_list:
-            if pro_serial_temp.starttime == starttime and pro_serial_temp.stoptime == stoptime:
-                pro_serial = pro_serial_temp
-                break
+        pro_serial = self.slots.get((starttime, stoptime))
         if pro_serial is None:
             pro_serial = ProSerial(self.day_task_id, starttime, stoptime)
-            self.pro_serial_list.append(pro_serial)
+            self.slots[(starttime, stoptime)] = pro_serial
+            # 按开始时间保持有序，相同开始时间按加入顺序排列
+            index = bisect.bisect_right(self.starttimes, starttime)
+            self.starttimes.insert(index, starttime)
+            self.pro_serial_list.insert(index, pro_serial)
         pro_serial.add_program(program.program_id)
 
+    def find_overlaps(self):
+        """
+        Sweep the slots in start order and pair each one with the earlier
+        slot still playing when it starts
+        """
+        overlaps = []
+        active = None
+        for pro_serial in self.pro_serial_list:
+            if active is not None and pro_serial.starttime <= active.stoptime:
+                overlaps.append((active, pro_serial))
+            if active is None or pro_serial.stoptime > active.stoptime:
+                active = pro_serial
+        return overlaps
+
     def to_et(self):
         attribute = {
             "id": str(self.day_task_id),
             "seq": str(self.seq),
         }
         elm = ET.Element("day_task", attrib=attribute)
-        for pro_serial in sorted(self.pro_serial_list, key=lambda k: k.starttime):
+        for pro_serial in self.pro_serial_list:
             elm.append(pro_serial.to_et())
         return elm
 
 
 class ProSerial:
+    __slots__ = ("pro_serial_id", "starttime", "stoptime", "program_ids")
+
     def __init__(self, pro_serial_id, starttime, stoptime):
         self.pro_serial_id = pro_serial_id
         self.starttime = starttime
@@ -339,3 +787,184 @@ class ProSerial:
             }
             elm.append(ET.Element("program", attrib=attribute))
         return elm
+
+
+
+def test_get_file_digests(tmp_path, monkeypatch):
+    import threading
+    from . import cache
+    paths = []
+    for index in range(6):
+        path = tmp_path / "{}.JPG".format(index)
+        path.write_bytes(b"jpeg" * index)
+        paths.append(str(path))
+    computed = []
+    threads = set()
+
+    def compute(file_path):
+        computed.append(file_path)
+        threads.add(threading.get_ident())
+        time.sleep(0.01)
+        with open(file_path, "rb") as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    monkeypatch.setattr(sys.modules[__name__], "compute_file_digest", compute)
+    digest_cache = cache.MemoryDigestCache({paths[0]: "cached"})
+    digests = get_file_digests(paths + paths[::-1], cache=digest_cache, workers=2)
+    # 重复的路径只计算一次，缓存命中的不计算
+    assert sorted(computed) == sorted(paths[1:])
+    assert len(threads) <= 2
+    assert digests[paths[0]] == "cached"
+    assert digests[paths[1]] == hashlib.md5(b"jpeg").hexdigest()
+    assert digest_cache.digests[paths[1]] == digests[paths[1]]
+
+    computed.clear()
+    assert get_file_digests(paths, cache=digest_cache, workers=2) == digests
+    assert computed == []
+
+def test_search_image_keeps_source_names(tmp_path):
+    library_path = tmp_path / "F0001.JPG"
+    library_path.write_bytes(b"jpeg")
+    for name in ["a.JPG", "b.JPG"]:
+        (tmp_path / name).write_bytes(b"jpeg")
+    tasklist = TaskList("test", startdate=time.localtime(), stopdate=time.localtime(), stable_ids=True)
+    tasklist.verbose = False
+    tasklist.set_filelist({"F0001.JPG": Asset("F0001.JPG", str(library_path), "4", "0")})
+    first = tasklist.create_program("早读", [str(tmp_path / "a.JPG")])
+    second = tasklist.create_program("午休", [str(tmp_path / "b.JPG")])
+    assert [img.get("name") for img in first.to_et().iter("img")] == ["a.JPG"]
+    assert [img.get("name") for img in second.to_et().iter("img")] == ["b.JPG"]
+    assert tasklist.get_referenced_images() == [tasklist.filelist["F0001.JPG"]]
+
+
+def test_prune_filelist(tmp_path):
+    filelist = {}
+    # F0003.JPG的大小未知时按文件实际大小计算
+    for name, size in [("F0001.JPG", "9"), ("F0002.JPG", "9"), ("F0003.JPG", None)]:
+        (tmp_path / name).write_bytes(name.encode("utf-8"))
+        filelist[name] = Asset(name, str(tmp_path / name), size, "0")
+    tasklist = TaskList("test", startdate=time.localtime(), stopdate=time.localtime(), stable_ids=True)
+    tasklist.set_filelist(filelist)
+    program = Program("早读", program_id="1")
+    program.create_imagerect([ImageEntry.get("F0002.JPG", "a.JPG")], rectid="2")
+    tasklist.programlist.append(program)
+    assert tasklist.prune_filelist() == (2, 18)
+    assert list(tasklist.filelist) == ["F0002.JPG"]
+    assert [elm.get("name") for elm in tasklist.create_filelist_xml().iter("file")] == ["F0002.JPG"]
+
+
+
+def test_incremental_save(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    library_dir = tmp_path / "library"
+    library_dir.mkdir()
+
+    def write_images(contents):
+        for index, data in enumerate(contents):
+            (library_dir / "F000{}.JPG".format(index + 1)).write_bytes(data)
+            (tmp_path / "{}.JPG".format("ab"[index])).write_bytes(data)
+
+    def build(names):
+        tasklist = TaskList("test", startdate=time.strptime("2021-03-15", "%Y-%m-%d"),
+                            stopdate=time.strptime("2022-04-30", "%Y-%m-%d"), stable_ids=True)
+        tasklist.verbose = False
+        tasklist.set_filelist({name: Asset(name, str(library_dir / name), str(os.path.getsize(str(library_dir / name))), "0")
+                               for name in ["F0001.JPG", "F0002.JPG"]})
+        program = tasklist.create_program("早读", [str(tmp_path / name) for name in names])
+        tasklist.add_schedule(program, starttime="07:00:00", stoptime="07:30:00", week_days=[0])
+        tasklist.prune_filelist()
+        return tasklist, tasklist.save(manifest.load_manifest(tasklist.get_task_dir()))
+
+    def snapshot():
+        return {str(path): (path.stat().st_mtime_ns, path.read_bytes()) for path in contents_dir.rglob("*.*")}
+
+    write_images([b"a" * 10, b"b" * 10])
+    tasklist, diff = build(["a.JPG", "b.JPG"])
+    assert diff["files"] == ["F0001.JPG", "F0002.JPG"]
+    contents_dir = tmp_path / tasklist.get_task_dir() / "Contents"
+    before = snapshot()
+
+    # 没有变化时不写任何文件，生成的内容完全相同
+    _, diff = build(["a.JPG", "b.JPG"])
+    assert manifest.format_plan(diff) == "up to date"
+    assert snapshot() == before
+
+    write_images([b"a" * 10, b"c" * 20])
+    _, diff = build(["a.JPG", "b.JPG"])
+    assert (diff["files"], diff["removed"]) == (["F0002.JPG"], [])
+    # tasklist.xml带有生成时间，在另一秒生成时也会改变
+    assert diff["xml"] in [["filelist.xml"], ["filelist.xml", "tasklist.xml"]]
+    after = snapshot()
+    changed = sorted(os.path.relpath(path, str(contents_dir)) for path in after if after[path] != before[path])
+    assert changed == [os.path.join("Files", "F0002.JPG")] + diff["xml"]
+
+    _, diff = build(["a.JPG"])
+    assert diff["removed"] == ["F0002.JPG"]
+    assert sorted(os.listdir(str(contents_dir / "Files"))) == ["F0001.JPG"]
+
+
+def test_create_playlist_xml():
+    import io
+    tasklist = TaskList("test", startdate=time.localtime(), stopdate=time.localtime(), stable_ids=True)
+    for program_id in ["1001", "1002"]:
+        program = Program("早读", program_id=program_id)
+        program.create_imagerect([ImageEntry.get("F0001.JPG", "a.JPG")], rectid="r" + program_id)
+        tasklist.programlist.append(program)
+    root = tasklist.create_playlist_xml()
+    assert [elm.get("path") for elm in root.iter("img")] == ["F0001.JPG", "F0001.JPG"]
+    assert b"F0001.JPG" in ET.tostring(root)
+    expected = io.BytesIO()
+    helper_xml.write_xml(root, expected)
+    rendered = io.BytesIO()
+    helper_xml.write_xml(tasklist.render()["playlist.xml"], rendered)
+    assert rendered.getvalue() == expected.getvalue()
+
+
+def test_image_entry_released():
+    import gc
+    entry = ImageEntry.get("F9999.JPG", "released.JPG")
+    assert ImageEntry.get("F9999.JPG", "released.JPG") is entry
+    del entry
+    gc.collect()
+    assert ("F9999.JPG", "released.JPG") not in ImageEntry.entries
+
+
+def test_match_files_by_head_digest(tmp_path):
+    filelist = {}
+    # 三个素材大小相同，F0002.JPG与源文件只有末尾不同，F0004.JPG登记的大小已过期
+    contents = {
+        "F0001.JPG": b"a" * HEAD_SIZE + b"a",
+        "F0002.JPG": b"b" * HEAD_SIZE + b"c",
+        "F0003.JPG": b"b" * HEAD_SIZE + b"b",
+        "F0004.JPG": b"d" * 10,
+    }
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+        filelist[name] = Asset(name, str(tmp_path / name), "1" if name == "F0004.JPG" else str(len(data)), "0")
+    for name, data in [("a.JPG", contents["F0003.JPG"]), ("b.JPG", contents["F0004.JPG"]), ("c.JPG", b"e")]:
+        (tmp_path / name).write_bytes(data)
+    size_index = SizeIndex(filelist)
+    assert [image_file.name for image_file in size_index.get(HEAD_SIZE + 1)] == ["F0001.JPG", "F0002.JPG", "F0003.JPG"]
+    sources = [str(tmp_path / name) for name in ["a.JPG", "b.JPG", "c.JPG"]]
+    matches, _ = match_files(sources, size_index)
+    assert {os.path.basename(path): image_file.name for path, image_file in matches.items()} == {
+        "a.JPG": "F0003.JPG", "b.JPG": "F0004.JPG",
+    }
+    # 开头不同的素材不必计算完整摘要
+    assert filelist["F0001.JPG"].digest is None
+    assert filelist["F0002.JPG"].digest is not None
+
+
+def test_day_task_slots():
+    day_task = DayTask(day_task_id=0, seq=1)
+    programs = [Program(name, program_id=str(index)) for index, name in enumerate(["早读", "课间", "午休", "放学"])]
+    day_task.add_program(programs[2], "12:00:00", "13:29:59")
+    day_task.add_program(programs[0], "07:30:00", "07:59:59")
+    day_task.add_program(programs[1], "07:30:00", "07:59:59")
+    day_task.add_program(programs[3], "13:00:00", "13:59:59")
+    assert [(pro_serial.starttime, pro_serial.program_ids) for pro_serial in day_task.pro_serial_list] == [
+        ("07:30:00", ["0", "1"]), ("12:00:00", ["2"]), ("13:00:00", ["3"]),
+    ]
+    assert [(first.starttime, second.starttime) for first, second in day_task.find_overlaps()] == [
+        ("12:00:00", "13:00:00"),
+    ]
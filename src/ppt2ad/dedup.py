@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Near-duplicate image detection with perceptual hashes
+'''
+
+import concurrent.futures
+import sqlite3
+
+from . import instrument
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+DEFAULT_CACHE_PATH = ".ppt2ad-phash.sqlite"
+DEFAULT_DISTANCE = 4
+# 纯色或大面积相同的页面哈希相同，还要求平均颜色接近
+COLOR_TOLERANCE = 24
+MODES = ["flag", "collapse"]
+
+
+def hamming(first, second):
+    return bin(first ^ second).count("1")
+
+
+def color_distance(first, second):
+    return max(abs((first >> shift & 0xff) - (second >> shift & 0xff)) for shift in (0, 8, 16))
+
+
+def compute_hashes(file_path):
+    """
+    64-bit average hash, difference hash and 24-bit mean color of an image,
+    or None if it is not one
+    """
+    try:
+        with Image.open(file_path) as image:
+            # JPEG可以按比例直接解码成小图，比完整解码快得多
+            image.draft("RGB", (64, 64))
+            red, green, blue = image.convert("RGB").resize((1, 1), Image.BOX).getpixel((0, 0))
+            gray = image.convert("L")
+    except (OSError, ValueError):
+        # 截断或损坏的图片也按非图片处理
+        return None
+    color = red << 16 | green << 8 | blue
+    pixels = list(gray.resize((8, 8), Image.BILINEAR).tobytes())
+    mean = sum(pixels) / len(pixels)
+    ahash = 0
+    for pixel in pixels:
+        ahash = ahash << 1 | (pixel > mean)
+    pixels = list(gray.resize((9, 8), Image.BILINEAR).tobytes())
+    dhash = 0
+    for row in range(8):
+        for column in range(8):
+            dhash = dhash << 1 | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return ahash, dhash, color
+
+
+class PerceptualHashCache:
+    """
+    Map file MD5 digests to their perceptual hashes
+    """
+    def __init__(self, db_path=DEFAULT_CACHE_PATH):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS phashes (digest TEXT PRIMARY KEY, ahash TEXT, dhash TEXT, color INTEGER)")
+
+    def lookup(self, digest):
+        row = self.conn.execute("SELECT ahash, dhash, color FROM phashes WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        return int(row[0], 16), int(row[1], 16), row[2]
+
+    def store(self, digest, hashes):
+        self.conn.execute("INSERT OR REPLACE INTO phashes VALUES (?, ?, ?, ?)",
+                          (digest, "{:016x}".format(hashes[0]), "{:016x}".format(hashes[1]), hashes[2]))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class MemoryPerceptualHashCache:
+    """
+    Perceptual hashes handed to batch worker processes
+    """
+    def __init__(self, hashes=None):
+        self.hashes = dict(hashes or {})
+
+    def lookup(self, digest):
+        return self.hashes.get(digest)
+
+    def store(self, digest, hashes):
+        self.hashes[digest] = hashes
+
+    def close(self):
+        pass
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with Hamming distance
+
+    A search only descends into children whose edge distance is within
+    max_distance of the query's distance to their parent.
+    """
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, [item], {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        (distance, item) of everything within max_distance of value
+        """
+        results = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    nodes.append(child)
+        return results
+
+
+def get_hashes(records, cache=None, workers=None):
+    """
+    Perceptual hashes of filelist records by digest, skipping non-images
+    """
+    if Image is None:
+        raise RuntimeError("Near-duplicate detection needs Pillow: pip install Pillow")
+    hashes = {}
+    missing = {}
+    for file_info in records:
+        digest = file_info.digest
+        if digest in hashes or digest in missing:
+            continue
+        cached = cache.lookup(digest) if cache is not None else None
+        if cached is None:
+            missing[digest] = file_info.path
+        else:
+            hashes[digest] = cached
+    with instrument.stage("perceptual_hash", images=len(missing)):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            computed = list(executor.map(compute_hashes, missing.values()))
+    for digest, result in zip(missing, computed):
+        if result is None:
+            continue
+        hashes[digest] = result
+        if cache is not None:
+            cache.store(digest, result)
+    return hashes
+
+
+def find_near_duplicates(records, hashes, max_distance=DEFAULT_DISTANCE):
+    """
+    Map each near-duplicate record name to the name of the record kept for it
+
+    Two images are near-duplicates when both their dHash and their aHash
+    are within max_distance bits and their mean colors are close.  The first record of a group, in the
+    order given, is the one kept.
+    """
+    tree = BKTree()
+    canonical = {}
+    seen = set()
+    for order, file_info in enumerate(records):
+        file_hashes = hashes.get(file_info.digest)
+        if file_hashes is None or file_info.name in seen:
+            continue
+        seen.add(file_info.name)
+        ahash, dhash, color = file_hashes
+        matches = sorted((distance, other_order, name) for distance, (other_order, name, other_ahash, other_color)
+                         in tree.search(dhash, max_distance)
+                         if hamming(ahash, other_ahash) <= max_distance
+                         and color_distance(color, other_color) <= COLOR_TOLERANCE)
+        if matches:
+            canonical[file_info.name] = matches[0][2]
+        else:
+            tree.add(dhash, (order, file_info.name, ahash, color))
+    return canonical
+
+
+def test_bk_tree():
+    tree = BKTree()
+    for value in [0b0000, 0b0001, 0b0111, 0b1111, 0b0001]:
+        tree.add(value, value)
+    assert sorted(tree.search(0b0011, 1)) == [(1, 0b0001), (1, 0b0001), (1, 0b0111)]
+    assert tree.search(0b1111, 0) == [(0, 0b1111)]
+
+
+def test_find_near_duplicates(tmp_path):
+    import pytest
+    from . import core
+    if Image is None:
+        pytest.skip("Pillow is not installed")
+    records = []
+    for name, quality, box, color in [("a.JPG", 95, (0, 0, 80, 45), 40), ("b.JPG", 60, (0, 0, 80, 45), 40),
+                                      ("c.JPG", 95, (80, 45, 160, 90), 40), ("d.JPG", 95, (0, 0, 80, 45), 120)]:
+        image = Image.new("L", (160, 90), color)
+        image.paste(255, box)
+        path = str(tmp_path / name)
+        image.save(path, "JPEG", quality=quality)
+        records.append(core.Asset(name, path, None, None, digest=name))
+    # 截断的图片不参与比较，也不中断生成
+    with open(records[0].path, "rb") as f:
+        (tmp_path / "e.JPG").write_bytes(f.read()[:400])
+    records.append(core.Asset("e.JPG", str(tmp_path / "e.JPG"), None, None, digest="e.JPG"))
+    hashes = get_hashes(records, cache=PerceptualHashCache(str(tmp_path / "phash.sqlite")))
+    assert "e.JPG" not in hashes
+    assert find_near_duplicates(records, hashes) == {"b.JPG": "a.JPG"}
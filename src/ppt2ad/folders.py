@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Index of the images/ tree
+'''
+
+import os
+
+from . import instrument
+
+
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+
+
+def is_image(filename):
+    return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+
+class FolderIndex:
+    """
+    Image files of every category folder below image_root, listed in a
+    single os.scandir pass together with their stat results
+    """
+    def __init__(self, image_root="images"):
+        self.image_root = image_root
+        self.folders = {}
+        self.stems = {}
+        self.stats = {}
+        self.scan()
+
+    def scan(self):
+        self.folders.clear()
+        self.stems.clear()
+        self.stats.clear()
+        if not os.path.isdir(self.image_root):
+            return
+        with instrument.stage("scan_folders", image_root=self.image_root):
+            with os.scandir(self.image_root) as folder_entries:
+                for folder_entry in folder_entries:
+                    if folder_entry.is_dir():
+                        self.scan_folder(folder_entry.name)
+
+    def scan_folder(self, folder):
+        image_dir = os.path.join(self.image_root, folder)
+        image_paths = []
+        stems = {}
+        with os.scandir(image_dir) as entries:
+            for entry in entries:
+                if not is_image(entry.name) or not entry.is_file():
+                    continue
+                image_path = os.path.join(image_dir, entry.name)
+                image_paths.append(image_path)
+                stems.setdefault(os.path.splitext(entry.name)[0], image_path)
+                self.stats[image_path] = entry.stat()
+        self.folders[folder] = image_paths
+        self.stems[folder] = stems
+
+    def update(self, paths):
+        """
+        Rescan the folders containing any of paths
+
+        Returns whether any path was below image_root.
+        """
+        image_root = os.path.abspath(self.image_root)
+        changed_folders = set()
+        for path in paths:
+            relpath = os.path.relpath(os.path.abspath(path), image_root)
+            if relpath.startswith(os.pardir):
+                continue
+            if relpath == os.curdir:
+                self.scan()
+                return True
+            changed_folders.add(relpath.split(os.sep)[0])
+        for folder in changed_folders:
+            for image_path in self.folders.pop(folder, []):
+                self.stats.pop(image_path, None)
+            self.stems.pop(folder, None)
+            if os.path.isdir(os.path.join(self.image_root, folder)):
+                self.scan_folder(folder)
+        return bool(changed_folders)
+
+    def get(self, folder):
+        """
+        Image paths in folder; raises FileNotFoundError like os.listdir
+        """
+        if folder not in self.folders:
+            raise FileNotFoundError("No such image folder: {}".format(os.path.join(self.image_root, folder)))
+        return self.folders[folder]
+
+    def find(self, folder, stem):
+        """
+        Path of the image named stem with any supported extension, or None
+        """
+        return self.stems.get(folder, {}).get(stem)
+
+    def get_all(self):
+        image_paths = []
+        for folder in sorted(self.folders):
+            image_paths.extend(self.folders[folder])
+        return image_paths
+
+
+def test_folder_index(tmp_path):
+    course_dir = tmp_path / "课程"
+    course_dir.mkdir()
+    for name in ["1-1.JPG", "1-2.jpeg", "2-1.png", "notes.txt"]:
+        (course_dir / name).write_bytes(b"x")
+    (tmp_path / "通用").mkdir()
+    (tmp_path / "通用" / "a.Jpg").write_bytes(b"xy")
+    index = FolderIndex(str(tmp_path))
+    assert sorted(os.path.basename(path) for path in index.get("课程")) == ["1-1.JPG", "1-2.jpeg", "2-1.png"]
+    assert index.find("课程", "1-2") == os.path.join(str(tmp_path), "课程", "1-2.jpeg")
+    assert index.find("课程", "3-1") is None
+    assert index.stats[os.path.join(str(tmp_path), "通用", "a.Jpg")].st_size == 2
+
+
+def test_folder_index_update(tmp_path):
+    (tmp_path / "通用").mkdir()
+    (tmp_path / "通用" / "a.JPG").write_bytes(b"x")
+    index = FolderIndex(str(tmp_path))
+    (tmp_path / "通用" / "b.JPG").write_bytes(b"xy")
+    (tmp_path / "午休").mkdir()
+    (tmp_path / "午休" / "c.JPG").write_bytes(b"xyz")
+    assert index.update([str(tmp_path / "通用" / "b.JPG"), str(tmp_path / "午休")])
+    assert len(index.get("通用")) == 2
+    assert index.find("午休", "c") == os.path.join(str(tmp_path), "午休", "c.JPG")
+    assert not index.update([str(tmp_path.parent / "elsewhere.JPG")])
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+LRU cache of serialized program fragments
+'''
+
+import collections
+import io
+
+from . import helper_xml
+
+
+DEFAULT_MAX_SIZE = 256
+# XML中不可能出现\0，用来标记需要替换成ID的位置
+PLACEHOLDER = "\0{}\0"
+
+
+class FragmentCache:
+    """
+    Serialized <program> elements keyed by content, with the program and
+    imagerect ids left as slots
+
+    Boards share programs such as 早读 or 午休 that differ only in their
+    ids, so each distinct program is turned into elements and serialized
+    once and later uses only fill in the ids.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.templates = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, program):
+        """
+        Fragment element rendering program through the cache
+        """
+        def render(current_indent, indent):
+            return self.render(program, current_indent, indent)
+        return helper_xml.Fragment("program", render, program.to_et)
+
+    def render(self, program, current_indent, indent):
+        key = (program.get_fragment_key(), current_indent, indent)
+        template = self.templates.get(key)
+        if template is None:
+            self.misses += 1
+            template = self.create_template(program, current_indent, indent)
+            self.templates[key] = template
+            if len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        else:
+            self.hits += 1
+            self.templates.move_to_end(key)
+        ids = [program.program_id] + [imagerect.rectid for imagerect in program.imagerects]
+        parts = list(template)
+        for index in range(1, len(parts), 2):
+            parts[index] = helper_xml.escape_data(ids[int(parts[index])]).encode("utf-8")
+        return b"".join(parts)
+
+    @staticmethod
+    def create_template(program, current_indent, indent):
+        """
+        Serialized program split at the id slots: text, slot, text, ...
+        """
+        elm = program.to_et()
+        elm.set("id", PLACEHOLDER.format(0))
+        for index, imagerect_elm in enumerate(elm.iter("imagerect")):
+            imagerect_elm.set("rectid", PLACEHOLDER.format(index + 1))
+        stream = io.BytesIO()
+        helper_xml.write_element(elm, stream, current_indent, indent)
+        return tuple(stream.getvalue().split(b"\0"))
+
+    def summary(self):
+        return "fragment cache: {} hits, {} misses".format(self.hits, self.misses)
+
+
+FRAGMENT_CACHE = FragmentCache()
+
+
+def test_fragment_cache():
+    from xml.etree import ElementTree
+    from . import core
+
+    images = [core.ImageEntry("F0001.JPG", "a & b.JPG"), core.ImageEntry("F0002.JPG", "c.JPG")]
+    cache = FragmentCache(max_size=1)
+    outputs = []
+    for program_id in ["1001", "1002"]:
+        program = core.Program("早读", program_id=program_id)
+        program.create_imagerect(images, rectid="r" + program_id)
+        root = ElementTree.Element("config")
+        root.append(cache.get(program))
+        stream = io.BytesIO()
+        helper_xml.write_xml(root, stream)
+        assert stream.getvalue() == helper_xml.prettify_xml(root).encode("utf-8")
+        expected = ElementTree.Element("config")
+        expected.append(program.to_et())
+        assert stream.getvalue() == helper_xml.prettify_xml(expected).encode("utf-8")
+        outputs.append(stream.getvalue())
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert outputs[0].replace(b'"1001"', b'"1002"').replace(b'"r1001"', b'"r1002"') == outputs[1]
+
+    cache.get(core.Program("午休", program_id="3")).render("", "    ")
+    assert len(cache.templates) == 1
@@ -11,14 +11,111 @@ Date: 2021/03/21 19:04:16
 
 
 from xml.etree import ElementTree
-from xml.dom import minidom
 
 
 def prettify_xml(root):
     """
     Serialize ElementTree with builtiful indentation
     """
-    original_bytes = ElementTree.tostring(root, encoding="utf-8")
+    # minidom只在这里用到，导入较慢
+    from xml.dom import minidom
+    original_bytes = ElementTree.tostring(expand_fragments(root), encoding="utf-8")
     original_text = original_bytes.decode(encoding="utf-8")
     dom = minidom.parseString(original_text)
     return dom.toprettyxml(indent="    ", encoding="utf-8").decode(encoding="utf-8")
+
+
+class Fragment(ElementTree.Element):
+    """
+    Element serialized by render(current_indent, indent) instead of its children
+
+    write_xml writes the rendered bytes as they are; expand() builds the
+    equivalent element for anything else that needs a real tree.
+    """
+    def __init__(self, tag, render, expand):
+        super().__init__(tag)
+        self.render = render
+        self.expand = expand
+
+
+def expand_fragments(elm):
+    if isinstance(elm, Fragment):
+        return elm.expand()
+    if not any(isinstance(child, Fragment) for child in elm.iter()):
+        return elm
+    copy = ElementTree.Element(elm.tag, dict(elm.items()))
+    copy.text = elm.text
+    copy.tail = elm.tail
+    copy.extend(expand_fragments(child) for child in elm)
+    return copy
+
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+
+def escape_data(value):
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def write_xml(root, stream, indent="    "):
+    """
+    Write ElementTree to a binary stream, byte-identical to prettify_xml
+
+    Elements are written one line at a time as they are visited, so no
+    intermediate copy of the document is built.
+    """
+    stream.write(XML_DECLARATION.encode("utf-8"))
+    write_element(root, stream, "", indent)
+
+
+def write_element(elm, stream, current_indent="", indent="    "):
+    if isinstance(elm, Fragment):
+        stream.write(elm.render(current_indent, indent))
+        return
+    parts = [current_indent, "<", elm.tag]
+    for name, value in elm.items():
+        parts.extend([" ", name, "=\"", escape_data(value), "\""])
+    children = list(elm)
+    if children:
+        parts.append(">\n")
+        stream.write("".join(parts).encode("utf-8"))
+        for child in children:
+            write_element(child, stream, current_indent + indent, indent)
+        stream.write("{}</{}>\n".format(current_indent, elm.tag).encode("utf-8"))
+    elif elm.text:
+        parts.extend([">", escape_data(elm.text), "</", elm.tag, ">\n"])
+        stream.write("".join(parts).encode("utf-8"))
+    else:
+        parts.append("/>\n")
+        stream.write("".join(parts).encode("utf-8"))
+
+
+class HashWriter:
+    """
+    Binary sink that digests what was written and forwards it to streams
+    """
+    def __init__(self, hasher, *streams):
+        self.hasher = hasher
+        self.streams = streams
+
+    def write(self, data):
+        self.hasher.update(data)
+        for stream in self.streams:
+            stream.write(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def test_write_xml():
+    import io
+    root = ElementTree.Element("config")
+    filelist = ElementTree.SubElement(root, "filelist", attrib={"taskid": "1", "taskname": "班牌 <1> & \"2\""})
+    ElementTree.SubElement(filelist, "file", attrib={"crc": "0", "name": "a.JPG", "size": "3"})
+    meta = ElementTree.SubElement(root, "meta")
+    meta.append(ElementTree.Element("files"))
+    ElementTree.SubElement(meta, "tts").text = "\"说明\" & <备注>"
+    stream = io.BytesIO()
+    write_xml(root, stream)
+    assert stream.getvalue() == prettify_xml(root).encode("utf-8")
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Per-stage timing and I/O counters for the build pipeline
+'''
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+COUNTERS = ["bytes_read", "bytes_written", "digests"]
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of this process in bytes, or None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+class Recorder:
+    """
+    Collect nested stage timings and counters while enabled
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.events = []
+        self.depth = 0
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.perf_counter()
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += value
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        if not self.enabled:
+            yield
+            return
+        before = dict(self.counters)
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            event = {
+                "name": name,
+                "depth": self.depth,
+                "start": start - self.origin,
+                "wall": time.perf_counter() - start,
+                "cpu": time.process_time() - cpu_start,
+                "peak_rss": get_peak_rss(),
+                "thread": threading.get_ident(),
+                "info": info,
+            }
+            for counter in COUNTERS:
+                event[counter] = self.counters[counter] - before[counter]
+            self.events.append(event)
+
+    def totals(self):
+        """
+        Aggregate events by stage name, in order of first appearance
+        """
+        totals = {}
+        for event in sorted(self.events, key=lambda event: event["start"]):
+            total = totals.setdefault(event["name"], dict(
+                {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak_rss": None, "depth": event["depth"]},
+                **dict.fromkeys(COUNTERS, 0)))
+            total["calls"] += 1
+            total["wall"] += event["wall"]
+            total["cpu"] += event["cpu"]
+            for counter in COUNTERS:
+                total[counter] += event[counter]
+            if event["peak_rss"] is not None:
+                total["peak_rss"] = max(total["peak_rss"] or 0, event["peak_rss"])
+        return totals
+
+    def summary(self):
+        lines = ["{:<28} {:>6} {:>9} {:>9} {:>10} {:>10} {:>8} {:>9}".format(
+            "stage", "calls", "wall(s)", "cpu(s)", "read(MB)", "write(MB)", "digests", "rss(MB)")]
+        for name, total in self.totals().items():
+            peak_rss = "-" if total["peak_rss"] is None else "{:.1f}".format(total["peak_rss"] / 1048576)
+            lines.append("{:<28} {:>6} {:>9.3f} {:>9.3f} {:>10.1f} {:>10.1f} {:>8} {:>9}".format(
+                "  " * total["depth"] + name, total["calls"], total["wall"], total["cpu"],
+                total["bytes_read"] / 1048576, total["bytes_written"] / 1048576, total["digests"], peak_rss))
+        return "\n".join(lines)
+
+    def to_trace_events(self):
+        """
+        Chrome trace event format, viewable in chrome://tracing or Perfetto
+        """
+        pid = os.getpid()
+        trace_events = []
+        for event in self.events:
+            args = dict(event["info"])
+            args.update({counter: event[counter] for counter in COUNTERS})
+            args["cpu_s"] = event["cpu"]
+            if event["peak_rss"] is not None:
+                args["peak_rss"] = event["peak_rss"]
+            trace_events.append({
+                "name": event["name"],
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["wall"] * 1e6,
+                "pid": pid,
+                "tid": event["thread"],
+                "args": args,
+            })
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_trace_events(), f, ensure_ascii=False)
+
+
+RECORDER = Recorder()
+
+
+def stage(name, **info):
+    return RECORDER.stage(name, **info)
+
+
+def count(name, value=1):
+    RECORDER.count(name, value)
+
+
+def test_recorder(tmp_path):
+    recorder = Recorder()
+    with recorder.stage("ignored"):
+        recorder.count("digests")
+    assert recorder.events == [] and recorder.counters["digests"] == 0
+
+    recorder.enable()
+    with recorder.stage("build", board="a"):
+        for _ in range(2):
+            with recorder.stage("search_image"):
+                recorder.count("digests", 3)
+                recorder.count("bytes_read", 1048576)
+        with recorder.stage("save"):
+            recorder.count("bytes_written", 2097152)
+    # 外层阶段包含内层阶段的计数
+    totals = recorder.totals()
+    assert list(totals) == ["build", "search_image", "save"]
+    assert [totals[name]["depth"] for name in totals] == [0, 1, 1]
+    assert (totals["search_image"]["calls"], totals["search_image"]["digests"]) == (2, 6)
+    assert (totals["build"]["digests"], totals["build"]["bytes_read"], totals["build"]["bytes_written"]) == (6, 2097152, 2097152)
+    assert totals["build"]["wall"] >= totals["search_image"]["wall"] + totals["save"]["wall"]
+
+    lines = recorder.summary().splitlines()
+    assert lines[0].split()[:3] == ["stage", "calls", "wall(s)"]
+    assert [line.split()[0] for line in lines[1:]] == ["build", "search_image", "save"]
+    assert lines[2].startswith("  search_image") and lines[2].split()[1:2] == ["2"]
+
+    path = str(tmp_path / "trace.json")
+    recorder.save(path)
+    with open(path, "r", encoding="utf-8") as f:
+        trace = json.load(f)
+    events = {event["name"]: event for event in trace["traceEvents"]}
+    assert len(trace["traceEvents"]) == 4
+    assert all(event["ph"] == "X" and event["pid"] == os.getpid() for event in trace["traceEvents"])
+    assert events["build"]["args"]["board"] == "a" and events["build"]["args"]["digests"] == 6
+    assert events["build"]["ts"] <= events["save"]["ts"]
+    assert events["save"]["ts"] + events["save"]["dur"] <= events["build"]["ts"] + events["build"]["dur"]
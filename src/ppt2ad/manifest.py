@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Build manifest for incremental package builds
+'''
+
+import json
+import os
+
+
+MANIFEST_NAME = "manifest.json"
+XML_DOCUMENTS = ["tasklist.xml", "filelist.xml", "playlist.xml", "tacticlist.xml"]
+
+
+def get_manifest_path(task_dir):
+    return os.path.join(task_dir, MANIFEST_NAME)
+
+
+def load_manifest(task_dir):
+    manifest_path = get_manifest_path(task_dir)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(task_dir, manifest):
+    manifest_path = get_manifest_path(task_dir)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def diff_manifest(previous, current):
+    """
+    Compare two manifests and return what has to be (re)written
+    """
+    if previous is None:
+        previous = {"inputs": {}, "files": {}, "xml": {}}
+    diff = {
+        "inputs": sorted(
+            path for path, digest in current["inputs"].items() if previous["inputs"].get(path) != digest
+        ),
+        "xml": sorted(
+            name for name, digest in current["xml"].items() if previous["xml"].get(name) != digest
+        ),
+        "files": sorted(
+            name for name, digest in current["files"].items() if previous["files"].get(name) != digest
+        ),
+        "removed": sorted(set(previous["files"]) - set(current["files"])),
+    }
+    return diff
+
+
+def is_unchanged(diff):
+    return not (diff["xml"] or diff["files"] or diff["removed"])
+
+
+def format_plan(diff):
+    lines = []
+    for path in diff["inputs"]:
+        lines.append("input   {}".format(path))
+    for name in diff["xml"]:
+        lines.append("write   {}".format(name))
+    for name in diff["files"]:
+        lines.append("write   Files/{}".format(name))
+    for name in diff["removed"]:
+        lines.append("remove  Files/{}".format(name))
+    if not lines:
+        lines.append("up to date")
+    return "\n".join(lines)
+
+
+def test_diff_manifest(tmp_path):
+    assert load_manifest(str(tmp_path)) is None
+    previous = {"inputs": {"a.jpg": "1"}, "xml": {"tasklist.xml": "1", "playlist.xml": "1"},
+                "files": {"a.JPG": "1", "b.JPG": "1"}}
+    save_manifest(str(tmp_path), previous)
+    assert load_manifest(str(tmp_path)) == previous
+
+    diff = diff_manifest(previous, previous)
+    assert is_unchanged(diff)
+    assert format_plan(diff) == "up to date"
+
+    current = {"inputs": {"a.jpg": "2"}, "xml": {"tasklist.xml": "1", "playlist.xml": "2"},
+               "files": {"a.JPG": "2", "c.JPG": "1"}}
+    diff = diff_manifest(previous, current)
+    assert not is_unchanged(diff)
+    assert diff == {"inputs": ["a.jpg"], "xml": ["playlist.xml"], "files": ["a.JPG", "c.JPG"], "removed": ["b.JPG"]}
+    assert format_plan(diff).splitlines() == [
+        "input   a.jpg", "write   playlist.xml", "write   Files/a.JPG", "write   Files/c.JPG", "remove  Files/b.JPG",
+    ]
+    assert diff_manifest(None, current)["files"] == ["a.JPG", "c.JPG"]
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Materialize asset files into a task directory
+'''
+
+import errno
+import os
+import shutil
+
+from . import instrument
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+FICLONE = 0x40049409
+CHUNK_SIZE = 1024 * 1024
+
+MODES = ["auto", "hardlink", "reflink", "copy_file_range", "sendfile", "copy"]
+
+FALLBACKS = {
+    "auto": ["reflink", "copy_file_range", "sendfile", "copy"],
+    "hardlink": ["hardlink", "reflink", "copy_file_range", "sendfile", "copy"],
+    "reflink": ["reflink", "copy_file_range", "sendfile", "copy"],
+    "copy_file_range": ["copy_file_range", "sendfile", "copy"],
+    "sendfile": ["sendfile", "copy"],
+    "copy": ["copy"],
+}
+
+# 这些错误说明文件系统或平台不支持该方式，其余错误（权限、磁盘满等）直接抛出
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS, errno.ENOTTY}
+# 硬链接在部分文件系统上返回EPERM，链接数达到上限时返回EMLINK
+LINK_UNSUPPORTED_ERRNOS = UNSUPPORTED_ERRNOS | {errno.EPERM, errno.EMLINK}
+
+
+def _link(src_path, tmp_path):
+    os.link(src_path, tmp_path)
+
+
+def _reflink(src_path, tmp_path):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflink is not supported on this platform")
+    with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _copy_file_range(src_path, tmp_path):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not supported on this platform")
+    with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), min(remaining, 1 << 30))
+            if copied == 0:
+                raise OSError(errno.EIO, "{} ended {} bytes early".format(src_path, remaining))
+            remaining -= copied
+
+
+def _sendfile(src_path, tmp_path):
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "sendfile is not supported on this platform")
+    with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, min(remaining, 1 << 30))
+            if sent == 0:
+                raise OSError(errno.EIO, "{} ended {} bytes early".format(src_path, remaining))
+            offset += sent
+            remaining -= sent
+
+
+def _copy(src_path, tmp_path):
+    with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+# strategies that really copy data, as opposed to sharing blocks or inodes
+COPYING_STRATEGIES = ["copy_file_range", "sendfile", "copy"]
+
+STRATEGIES = {
+    "hardlink": _link,
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "copy": _copy,
+}
+
+
+class Materializer:
+    """
+    Place source files at destination paths with the cheapest strategy the
+    filesystem supports, falling back along FALLBACKS[mode]
+    """
+    def __init__(self, mode="auto"):
+        if mode not in FALLBACKS:
+            raise ValueError("Unknown materialization mode: {}".format(mode))
+        self.mode = mode
+        self.unsupported = set()
+        self.counts = {}
+
+    def materialize(self, src_path, dst_path):
+        tmp_path = "{}.{}.tmp".format(dst_path, os.getpid())
+        strategies = [name for name in FALLBACKS[self.mode] if name not in self.unsupported]
+        for name in strategies:
+            try:
+                STRATEGIES[name](src_path, tmp_path)
+            except OSError as e:
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                unsupported = LINK_UNSUPPORTED_ERRNOS if name == "hardlink" else UNSUPPORTED_ERRNOS
+                if name == "copy" or e.errno not in unsupported:
+                    raise
+                self.unsupported.add(name)
+                continue
+            os.replace(tmp_path, dst_path)
+            if name in COPYING_STRATEGIES:
+                size = os.path.getsize(dst_path)
+                instrument.count("bytes_written", size)
+                if name == "copy":
+                    instrument.count("bytes_read", size)
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return name
+        raise OSError("No materialization strategy left for {}".format(dst_path))
+
+    def summary(self):
+        counts = ", ".join("{} {}".format(count, name) for name, count in sorted(self.counts.items()))
+        return "materialized: {}".format(counts or "nothing")
+
+
+def test_materialize_fallback(tmp_path, monkeypatch):
+    import pytest
+
+    def fail(code):
+        def strategy(src_path, tmp_path):
+            open(tmp_path, "wb").close()
+            raise OSError(code, os.strerror(code))
+        return strategy
+
+    src = tmp_path / "src.JPG"
+    src.write_bytes(b"x" * 1000)
+    monkeypatch.setitem(STRATEGIES, "hardlink", fail(errno.EPERM))
+    monkeypatch.setitem(STRATEGIES, "reflink", fail(errno.EOPNOTSUPP))
+    monkeypatch.setitem(STRATEGIES, "copy_file_range", fail(errno.EXDEV))
+    materializer = Materializer("hardlink")
+    assert materializer.materialize(str(src), str(tmp_path / "a.JPG")) in ["sendfile", "copy"]
+    assert (tmp_path / "a.JPG").read_bytes() == src.read_bytes()
+    assert {"hardlink", "reflink", "copy_file_range"} <= materializer.unsupported
+    assert sorted(os.listdir(str(tmp_path))) == ["a.JPG", "src.JPG"]
+
+    # 其他错误不会让该方式被永久跳过
+    monkeypatch.setitem(STRATEGIES, "reflink", fail(errno.ENOSPC))
+    materializer = Materializer("reflink")
+    with pytest.raises(OSError):
+        materializer.materialize(str(src), str(tmp_path / "b.JPG"))
+    assert not materializer.unsupported
+    assert not (tmp_path / "b.JPG").exists()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Normalize images to the playback canvas
+'''
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import zlib
+
+from . import archive
+from . import instrument
+
+try:
+    from PIL import Image
+    from PIL import ImageOps
+except ImportError:
+    Image = None
+
+
+DEFAULT_CACHE_PATH = ".ppt2ad-normalized"
+CANVAS_WIDTH = 1080
+CANVAS_HEIGHT = 1920
+DEFAULT_QUALITY = 85
+
+
+def normalize_image(src_path, dst_path, params):
+    """
+    Fit src_path into the canvas and re-encode it to dst_path
+
+    Returns None and leaves dst_path alone if src_path is not a readable image.
+    """
+    tmp_path = "{}.{}.tmp".format(dst_path, os.getpid())
+    try:
+        with Image.open(src_path) as image:
+            # 按EXIF方向旋转后再去掉EXIF，否则图片会转向
+            image = ImageOps.exif_transpose(image)
+            exif = None if params["strip_metadata"] else image.info.get("exif")
+            if image.width > params["width"] or image.height > params["height"]:
+                image.thumbnail((params["width"], params["height"]), Image.LANCZOS)
+            options = {}
+            if exif:
+                options["exif"] = exif
+            if params["format"] == "PNG":
+                image.save(tmp_path, "PNG", optimize=True, **options)
+            else:
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                # 低功耗播放端解码基线JPEG更快
+                image.save(tmp_path, "JPEG", quality=params["quality"], optimize=True, progressive=False, **options)
+    except (OSError, ValueError):
+        # 截断或损坏的图片也按非图片处理
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+class Normalizer:
+    """
+    Resize and re-encode filelist images, cached by source digest and parameters
+
+    Normalized files live under cache_dir and are shared by every board and
+    run, so each slide is transcoded once.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_PATH, width=CANVAS_WIDTH, height=CANVAS_HEIGHT,
+                 quality=DEFAULT_QUALITY, strip_metadata=True, workers=None):
+        if Image is None:
+            raise RuntimeError("Image normalization needs Pillow: pip install Pillow")
+        self.cache_dir = cache_dir
+        self.params = {"width": width, "height": height, "quality": quality, "strip_metadata": strip_metadata}
+        self.workers = workers
+        self.transcoded = 0
+        self.reused = 0
+
+    def get_params(self, name):
+        params = dict(self.params)
+        params["format"] = "PNG" if name.lower().endswith(".png") else "JPEG"
+        return params
+
+    def get_cache_path(self, digest, params):
+        key = hashlib.md5("{}:{}".format(digest, json.dumps(params, sort_keys=True)).encode("utf-8")).hexdigest()
+        extension = ".png" if params["format"] == "PNG" else ".jpg"
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def prepare(self, filelist):
+        """
+        Make sure every record has its normalized file, returning name -> path
+
+        Records that are not images are left out of the result.
+        """
+        paths = {}
+        pending = {}
+        for file_info in filelist.values():
+            params = self.get_params(file_info.name)
+            cache_path = self.get_cache_path(file_info.digest, params)
+            paths[file_info.name] = cache_path
+            if os.path.exists(cache_path):
+                self.reused += 1
+            elif cache_path not in pending:
+                pending[cache_path] = (file_info.path, params)
+        with instrument.stage("normalize", images=len(pending)):
+            for cache_path in pending:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            if len(pending) == 1 or self.workers == 1:
+                results = [normalize_image(src_path, cache_path, params)
+                           for cache_path, (src_path, params) in pending.items()]
+            elif pending:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    futures = [executor.submit(normalize_image, src_path, cache_path, params)
+                               for cache_path, (src_path, params) in pending.items()]
+                    results = [future.result() for future in futures]
+            else:
+                results = []
+        self.transcoded += sum(1 for result in results if result is not None)
+        # 不是图片的素材保持原样
+        failed = set(cache_path for cache_path, result in zip(pending, results) if result is None)
+        return {name: cache_path for name, cache_path in paths.items() if cache_path not in failed}
+
+    def normalize(self, filelist):
+        """
+        Replace filelist records by ones pointing at their normalized files
+        """
+        paths = self.prepare(filelist)
+        for name, cache_path in paths.items():
+            with open(cache_path, "rb") as f:
+                data = f.read()
+            filelist[name] = filelist[name].replace(path=cache_path, size=str(len(data)),
+                                                    crc=archive.format_crc(zlib.crc32(data), like=filelist[name].crc),
+                                                    digest=hashlib.md5(data).hexdigest())
+
+    def summary(self):
+        return "normalized: {} transcoded, {} reused".format(self.transcoded, self.reused)
+
+
+def test_normalizer(tmp_path):
+    import pytest
+    from . import core
+    if Image is None:
+        pytest.skip("Pillow is not installed")
+    src_path = str(tmp_path / "slide.JPG")
+    Image.new("RGB", (2160, 3840), (200, 10, 10)).save(src_path, "JPEG", quality=95)
+    filelist = {"F0001.JPG": core.Asset("F0001.JPG", src_path, "0", "0", digest="abc")}
+    normalizer = Normalizer(cache_dir=str(tmp_path / "cache"), workers=1)
+    normalizer.normalize(filelist)
+    file_info = filelist["F0001.JPG"]
+    with Image.open(file_info.path) as image:
+        assert image.size == (CANVAS_WIDTH, CANVAS_HEIGHT)
+        assert "exif" not in image.info
+    assert file_info.size == str(os.path.getsize(file_info.path))
+
+    filelist = {"F0001.JPG": core.Asset("F0001.JPG", src_path, "0", "0", digest="abc")}
+    normalizer.normalize(filelist)
+    assert (normalizer.transcoded, normalizer.reused) == (1, 1)
+
+    # 截断的图片保持原样，也不留下临时文件
+    broken_path = str(tmp_path / "broken.JPG")
+    with open(src_path, "rb") as src, open(broken_path, "wb") as dst:
+        dst.write(src.read(2000))
+    filelist = {"F0002.JPG": core.Asset("F0002.JPG", broken_path, "2000", "0", digest="def")}
+    normalizer.normalize(filelist)
+    assert filelist["F0002.JPG"].path == broken_path
+    assert not [name for root, dirs, files in os.walk(normalizer.cache_dir) for name in files if name.endswith(".tmp")]
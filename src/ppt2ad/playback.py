@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Compiled playback calendar of a task
+'''
+
+import bisect
+import datetime
+import os
+import xml.etree.ElementTree as ET
+
+
+DAY_SECONDS = 24 * 3600
+WEEK_DAY_NAMES = "一二三四五六日"
+
+
+def parse_seconds(text):
+    hours, minutes, seconds = (int(part) for part in text.split(":"))
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def format_seconds(seconds):
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    # time.struct_time
+    return datetime.date(value.tm_year, value.tm_mon, value.tm_mday)
+
+
+class PlaybackCalendar:
+    """
+    What a multi_task plays, compiled into disjoint segments per week day
+
+    boundaries[week_day] is a sorted list of seconds since midnight and
+    segments[week_day][i] the program ids playing from boundaries[i] up to
+    boundaries[i + 1], so every query is a bisect on one list.  Week days
+    count from Monday = 0, like datetime.date.weekday().
+    """
+    def __init__(self, startdate, stopdate, slots, names=None):
+        """
+        slots[week_day] lists (start seconds, stop seconds, program ids), stop exclusive
+        """
+        self.startdate = to_date(startdate)
+        self.stopdate = to_date(stopdate)
+        self.names = dict(names or {})
+        self.boundaries = []
+        self.segments = []
+        self.airtimes = []
+        for week_day in range(7):
+            boundaries, segments = self.compile_day(slots[week_day])
+            self.boundaries.append(boundaries)
+            self.segments.append(segments)
+            airtime = {}
+            for index, program_ids in enumerate(segments):
+                for program_id in program_ids:
+                    airtime[program_id] = airtime.get(program_id, 0) + boundaries[index + 1] - boundaries[index]
+            self.airtimes.append(airtime)
+
+    @staticmethod
+    def compile_day(day_slots):
+        events = {}
+        for start, stop, program_ids in day_slots:
+            if stop <= start:
+                continue
+            events.setdefault(start, []).append((1, program_ids))
+            events.setdefault(stop, []).append((-1, program_ids))
+        boundaries = []
+        segments = []
+        playing = {}
+        for boundary in sorted(events):
+            for delta, program_ids in events[boundary]:
+                for program_id in program_ids:
+                    playing[program_id] = playing.get(program_id, 0) + delta
+                    if not playing[program_id]:
+                        del playing[program_id]
+            boundaries.append(boundary)
+            segments.append(tuple(playing))
+        # 同时播放的节目按开始顺序排列，最后一个边界之后没有节目
+        if segments:
+            segments.pop()
+        return boundaries, segments
+
+    @classmethod
+    def from_multi_task(cls, multi_task, names=None):
+        slots = [[] for _ in range(7)]
+        start_week_day = multi_task.startdate.tm_wday
+        for index, day_task in enumerate(multi_task.day_tasks):
+            week_day = (start_week_day + index) % 7
+            for pro_serial in day_task.pro_serial_list:
+                slots[week_day].append((parse_seconds(pro_serial.starttime),
+                                        parse_seconds(pro_serial.stoptime) + 1, pro_serial.program_ids))
+        return cls(multi_task.startdate, multi_task.stopdate, slots, names)
+
+    @classmethod
+    def from_tasklist(cls, tasklist):
+        names = {program.program_id: program.name for program in tasklist.programlist}
+        return cls.from_multi_task(tasklist.multi_task, names)
+
+    @classmethod
+    def from_task_dir(cls, task_dir):
+        """
+        Compile the calendar of a generated task from its tacticlist.xml and playlist.xml
+        """
+        contents_dir = os.path.join(task_dir, "Contents")
+        names = {}
+        for _, elm in ET.iterparse(os.path.join(contents_dir, "playlist.xml")):
+            if elm.tag == "program":
+                names[elm.get("id")] = elm.get("name")
+                elm.clear()
+        root = ET.parse(os.path.join(contents_dir, "tacticlist.xml")).getroot()
+        multi_task = root.find("multi_task")
+        startdate = to_date(multi_task.get("startdate"))
+        slots = [[] for _ in range(7)]
+        for index, day_task in enumerate(multi_task.findall("day_task")):
+            week_day = (startdate.weekday() + index) % 7
+            for pro_serial in day_task.findall("pro_serial"):
+                program_ids = [program.get("id") for program in pro_serial.findall("program")]
+                slots[week_day].append((parse_seconds(pro_serial.get("starttime")),
+                                        parse_seconds(pro_serial.get("stoptime")) + 1, program_ids))
+        return cls(startdate, multi_task.get("stopdate"), slots, names)
+
+    def get_name(self, program_id):
+        return self.names.get(program_id, program_id)
+
+    def in_term(self, date):
+        return self.startdate <= date <= self.stopdate
+
+    def at(self, when):
+        """
+        Names of the programs playing at the datetime when
+        """
+        if not self.in_term(when.date()):
+            return []
+        week_day = when.weekday()
+        seconds = when.hour * 3600 + when.minute * 60 + when.second
+        boundaries = self.boundaries[week_day]
+        index = bisect.bisect_right(boundaries, seconds) - 1
+        if index < 0 or index >= len(self.segments[week_day]):
+            return []
+        return [self.get_name(program_id) for program_id in self.segments[week_day][index]]
+
+    def between(self, start, stop):
+        """
+        (start, stop, program names) for everything playing between two datetimes
+        """
+        results = []
+        date = start.date()
+        while date <= stop.date():
+            if self.in_term(date):
+                midnight = datetime.datetime.combine(date, datetime.time())
+                first = max(int((start - midnight).total_seconds()), 0)
+                last = min(int((stop - midnight).total_seconds()), DAY_SECONDS)
+                results.extend(self.between_seconds(midnight, date.weekday(), first, last))
+            date += datetime.timedelta(days=1)
+        return results
+
+    def between_seconds(self, midnight, week_day, first, last):
+        boundaries = self.boundaries[week_day]
+        segments = self.segments[week_day]
+        index = max(bisect.bisect_right(boundaries, first) - 1, 0)
+        results = []
+        while index < len(segments) and boundaries[index] < last:
+            program_ids = segments[index]
+            if program_ids:
+                segment_start = max(boundaries[index], first)
+                segment_stop = min(boundaries[index + 1], last)
+                if segment_start < segment_stop:
+                    results.append((midnight + datetime.timedelta(seconds=segment_start),
+                                    midnight + datetime.timedelta(seconds=segment_stop),
+                                    [self.get_name(program_id) for program_id in program_ids]))
+            index += 1
+        return results
+
+    def gaps(self, week_day):
+        """
+        (start, stop) seconds without any program between the first and last program of the day
+        """
+        boundaries = self.boundaries[week_day]
+        return [(boundaries[index], boundaries[index + 1])
+                for index, program_ids in enumerate(self.segments[week_day]) if not program_ids]
+
+    def count_week_days(self):
+        days = (self.stopdate - self.startdate).days + 1
+        if days <= 0:
+            return [0] * 7
+        counts = [days // 7] * 7
+        for offset in range(days % 7):
+            counts[(self.startdate.weekday() + offset) % 7] += 1
+        return counts
+
+    def airtime(self):
+        """
+        Seconds each program plays over the whole term
+        """
+        totals = {}
+        for week_day, count in enumerate(self.count_week_days()):
+            for program_id, seconds in self.airtimes[week_day].items():
+                name = self.get_name(program_id)
+                totals[name] = totals.get(name, 0) + seconds * count
+        return totals
+
+    def coverage(self):
+        """
+        Per week day span, airtime and gaps, and airtime per program over the term
+        """
+        week_days = []
+        for week_day in range(7):
+            boundaries = self.boundaries[week_day]
+            gaps = self.gaps(week_day)
+            week_days.append({
+                "week_day": week_day,
+                "first": format_seconds(boundaries[0]) if boundaries else None,
+                "last": format_seconds(boundaries[-1]) if boundaries else None,
+                "airtime": sum(stop - start for start, stop in zip(boundaries, boundaries[1:])) - sum(
+                    stop - start for start, stop in gaps),
+                "gaps": [(format_seconds(start), format_seconds(stop)) for start, stop in gaps],
+            })
+        return {
+            "startdate": self.startdate.isoformat(),
+            "stopdate": self.stopdate.isoformat(),
+            "days": sum(self.count_week_days()),
+            "week_days": week_days,
+            "programs": self.airtime(),
+        }
+
+
+def format_coverage(coverage):
+    lines = ["{} - {}, {} days".format(coverage["startdate"], coverage["stopdate"], coverage["days"])]
+    for day in coverage["week_days"]:
+        if day["first"] is None:
+            lines.append("周{}: -".format(WEEK_DAY_NAMES[day["week_day"]]))
+            continue
+        lines.append("周{}: {}-{} {:.1f}h, {} gaps {}".format(
+            WEEK_DAY_NAMES[day["week_day"]], day["first"], day["last"], day["airtime"] / 3600,
+            len(day["gaps"]), " ".join("{}-{}".format(start, stop) for start, stop in day["gaps"])).rstrip())
+    for name, seconds in sorted(coverage["programs"].items(), key=lambda item: -item[1]):
+        lines.append("{:<12} {:>9.1f}h".format(name, seconds / 3600))
+    return "\n".join(lines)
+
+
+def test_playback_calendar():
+    # 2021-03-15 是周一，day_task按起始日期轮转
+    slots = [[] for _ in range(7)]
+    slots[0] = [(8 * 3600, 9 * 3600, ["a"]), (8 * 3600 + 1800, 10 * 3600, ["b"]), (11 * 3600, 12 * 3600, ["a"])]
+    slots[2] = [(8 * 3600, 9 * 3600, ["c"])]
+    calendar = PlaybackCalendar("2021-03-15", "2021-03-28", slots, names={"a": "早读"})
+    assert calendar.at(datetime.datetime(2021, 3, 15, 8, 45)) == ["早读", "b"]
+    assert calendar.at(datetime.datetime(2021, 3, 15, 10, 30)) == []
+    assert calendar.at(datetime.datetime(2021, 3, 22, 11, 59, 59)) == ["早读"]
+    assert calendar.at(datetime.datetime(2021, 3, 29, 8, 45)) == []
+    assert calendar.gaps(0) == [(10 * 3600, 11 * 3600)]
+    segments = calendar.between(datetime.datetime(2021, 3, 15, 8, 50), datetime.datetime(2021, 3, 17, 8, 30))
+    assert [names for _, _, names in segments] == [["早读", "b"], ["b"], ["早读"], ["c"]]
+    assert segments[-1][1] == datetime.datetime(2021, 3, 17, 8, 30)
+    assert calendar.airtime() == {"早读": 4 * 3600, "b": 3 * 3600, "c": 2 * 3600}
+    assert calendar.coverage()["week_days"][0]["airtime"] == 3 * 3600
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Publish task directories to an HTTP endpoint
+'''
+
+import asyncio
+import json
+import os
+import ssl
+import urllib.parse
+import xml.etree.ElementTree as ET
+import zlib
+
+from . import archive
+from . import core
+
+
+CHUNK_SIZE = 4 * 1024 * 1024
+# tasklist.xml最后上传，播放端看到它时其余文件都已就绪
+UPLOAD_ORDER = ["filelist.xml", "playlist.xml", "tacticlist.xml", "tasklist.xml"]
+
+
+class PublishError(Exception):
+    pass
+
+
+class HttpConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections to one host, at most size at a time
+    """
+    def __init__(self, host, port, use_ssl=False, size=8, timeout=30):
+        self.host = host
+        self.port = port
+        self.ssl = ssl.create_default_context() if use_ssl else None
+        self.semaphore = asyncio.Semaphore(size)
+        self.timeout = timeout
+        self.idle = []
+
+    async def request(self, method, path, headers=None, body=b""):
+        async with self.semaphore:
+            if self.idle:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout)
+            try:
+                lines = ["{} {} HTTP/1.1".format(method, path), "Host: {}".format(self.host),
+                         "Content-Length: {}".format(len(body))]
+                lines.extend("{}: {}".format(name, value) for name, value in (headers or {}).items())
+                writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+                status, response_headers, response_body = await asyncio.wait_for(
+                    read_response(reader), self.timeout)
+            except BaseException:
+                writer.close()
+                raise
+            if response_headers.get("connection", "").lower() == "close":
+                writer.close()
+            else:
+                self.idle.append((reader, writer))
+            return status, response_headers, response_body
+
+    async def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("connection closed by server")
+    status = int(status_line.split()[1])
+    headers = await read_headers(reader)
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+        return status, headers, bytes(body)
+    if "content-length" in headers:
+        return status, headers, await reader.readexactly(int(headers["content-length"]))
+    headers["connection"] = "close"
+    return status, headers, await reader.read()
+
+
+class HttpEndpoint:
+    """
+    Upload target speaking a small REST protocol below url:
+
+    GET <url>/<taskid>/inventory
+        {"files": {relpath: {"size": "...", "crc": "..."}}, "partial": {relpath: offset}}
+    GET <url>/<taskid>/files/<relpath>?offset
+        {"offset": bytes received so far}
+    PUT <url>/<taskid>/files/<relpath>
+        one chunk, Content-Range: bytes first-last/total, X-Crc32 and X-Size of
+        the whole file; 409 with {"offset": n} if first is not where the
+        target stands
+    """
+    def __init__(self, url, connections=8, timeout=30):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ["http", "https"]:
+            raise ValueError("Unsupported endpoint: {}".format(url))
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.base = parts.path.rstrip("/")
+        self.pool = HttpConnectionPool(parts.hostname, port, use_ssl=parts.scheme == "https",
+                                       size=connections, timeout=timeout)
+
+    def get_path(self, taskid, *parts):
+        return "/".join([self.base, urllib.parse.quote(str(taskid))] + [urllib.parse.quote(part) for part in parts])
+
+    async def request_json(self, method, path):
+        status, _, body = await self.pool.request(method, path)
+        if status == 404:
+            return None
+        if status >= 300:
+            raise PublishError("{} {} returned {}".format(method, path, status))
+        return json.loads(body.decode("utf-8"))
+
+    async def get_inventory(self, taskid):
+        inventory = await self.request_json("GET", self.get_path(taskid, "inventory"))
+        return inventory or {"files": {}, "partial": {}}
+
+    async def get_offset(self, taskid, relpath):
+        result = await self.request_json("GET", self.get_path(taskid, "files", relpath) + "?offset")
+        return 0 if result is None else result["offset"]
+
+    async def put_chunk(self, taskid, relpath, offset, data, size, crc):
+        if size:
+            content_range = "bytes {}-{}/{}".format(offset, offset + len(data) - 1, size)
+        else:
+            content_range = "bytes */0"
+        headers = {"Content-Range": content_range, "X-Size": str(size), "X-Crc32": crc}
+        path = self.get_path(taskid, "files", relpath)
+        status, _, body = await self.pool.request("PUT", path, headers=headers, body=data)
+        if status == 409:
+            return json.loads(body.decode("utf-8"))["offset"]
+        if status >= 300:
+            raise PublishError("PUT {} returned {}".format(path, status))
+        return offset + len(data)
+
+    async def close(self):
+        await self.pool.close()
+
+
+ENDPOINTS = {
+    "http": HttpEndpoint,
+    "https": HttpEndpoint,
+}
+
+
+def create_endpoint(url, **kwargs):
+    scheme = urllib.parse.urlsplit(url).scheme
+    if scheme not in ENDPOINTS:
+        raise ValueError("Unsupported endpoint: {}".format(url))
+    return ENDPOINTS[scheme](url, **kwargs)
+
+
+def compute_crc(path):
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+    return archive.format_crc(crc)
+
+
+def list_task_files(task_dir):
+    """
+    (relpath, path, size, crc) of a task, Files first and tasklist.xml last
+
+    Files take their crc from filelist.xml and their size from stat, so
+    nothing large is read just to find out that the target already has it.
+    """
+    contents_dir = os.path.join(task_dir, "Contents")
+    task_files = []
+    for name, file_info in core.load_filelist(os.path.join(contents_dir, "filelist.xml")).items():
+        size = os.path.getsize(file_info.path)
+        task_files.append(("Contents/Files/" + name, file_info.path, size, file_info.crc))
+    for name in UPLOAD_ORDER:
+        path = os.path.join(contents_dir, name)
+        task_files.append(("Contents/" + name, path, os.path.getsize(path), compute_crc(path)))
+    return task_files
+
+
+class Publisher:
+    """
+    Upload task directories through an endpoint, skipping what it already has
+    """
+    def __init__(self, endpoint, jobs=8, retries=5, chunk_size=CHUNK_SIZE, backoff=0.5):
+        self.endpoint = endpoint
+        self.semaphore = asyncio.Semaphore(jobs)
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.backoff = backoff
+        self.uploaded = 0
+        self.skipped = 0
+        self.bytes_sent = 0
+
+    async def retry(self, action, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return await action(*args)
+            except (OSError, EOFError, asyncio.TimeoutError, PublishError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def upload_file(self, taskid, relpath, path, size, crc, offset=0):
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    if attempt:
+                        # 断线后从目标已收到的位置继续
+                        offset = await self.endpoint.get_offset(taskid, relpath)
+                    with open(path, "rb") as f:
+                        while True:
+                            f.seek(offset)
+                            data = await loop.run_in_executor(None, f.read, self.chunk_size)
+                            if not data and offset < size:
+                                raise PublishError("{} is shorter than {} bytes".format(path, size))
+                            sent = await self.endpoint.put_chunk(taskid, relpath, offset, data, size, crc)
+                            if sent <= offset and size:
+                                # 目标没有接收任何数据，重试时重新查询位置
+                                raise PublishError("{} made no progress at offset {}".format(relpath, offset))
+                            if sent == offset + len(data):
+                                self.bytes_sent += len(data)
+                            offset = sent
+                            if offset >= size:
+                                break
+                    self.uploaded += 1
+                    return
+                except (OSError, EOFError, asyncio.TimeoutError, PublishError):
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def publish_task(self, task_dir):
+        taskid = os.path.basename(os.path.normpath(task_dir))
+        task_files = list_task_files(task_dir)
+        inventory = await self.retry(self.endpoint.get_inventory, taskid)
+        pending = []
+        for relpath, path, size, crc in task_files:
+            remote = inventory["files"].get(relpath)
+            if remote is not None and int(remote["size"]) == size and remote["crc"] == crc:
+                self.skipped += 1
+                continue
+            pending.append((relpath, path, size, crc, inventory.get("partial", {}).get(relpath, 0)))
+        files = [item for item in pending if item[0].startswith("Contents/Files/")]
+        await asyncio.gather(*(self.upload_file(taskid, *item) for item in files))
+        for item in pending:
+            if item not in files:
+                await self.upload_file(taskid, *item)
+        return taskid
+
+    async def publish(self, task_dirs):
+        """
+        Publish task_dirs concurrently, returning {task_dir: exception or None}
+        """
+        results = await asyncio.gather(*(self.publish_task(task_dir) for task_dir in task_dirs),
+                                       return_exceptions=True)
+        return {task_dir: result if isinstance(result, BaseException) else None
+                for task_dir, result in zip(task_dirs, results)}
+
+    def summary(self):
+        return "published: {} uploaded, {} skipped, {:.1f} KB sent".format(
+            self.uploaded, self.skipped, self.bytes_sent / 1024)
+
+
+async def publish_task_dirs(task_dirs, url, jobs=8, connections=8, retries=5, chunk_size=CHUNK_SIZE):
+    endpoint = create_endpoint(url, connections=connections)
+    publisher = Publisher(endpoint, jobs=jobs, retries=retries, chunk_size=chunk_size)
+    try:
+        results = await publisher.publish(task_dirs)
+    finally:
+        await endpoint.close()
+    return publisher, results
+
+
+class StubServer:
+    """
+    In-process target implementing the HttpEndpoint protocol under root
+
+    fail_puts lists PUT request numbers (counting from 1) on which the
+    connection is dropped, to exercise resuming.
+    """
+    def __init__(self, root, fail_puts=()):
+        self.root = root
+        self.fail_puts = set(fail_puts)
+        self.puts = 0
+        self.meta = {}
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        return "http://{}:{}/tasks".format(host, port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def get_path(self, taskid, relpath):
+        return os.path.join(self.root, taskid, *relpath.split("/"))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split()
+                headers = await read_headers(reader)
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                if method == "PUT":
+                    self.puts += 1
+                    if self.puts in self.fail_puts:
+                        break
+                status, response = self.respond(method, target, headers, body)
+                payload = json.dumps(response).encode("utf-8")
+                writer.write("HTTP/1.1 {} -\r\nContent-Length: {}\r\n\r\n".format(status, len(payload)).encode("latin-1"))
+                writer.write(payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, method, target, headers, body):
+        path, _, query = target.partition("?")
+        parts = [urllib.parse.unquote(part) for part in path.split("/")[2:]]
+        taskid = parts[0]
+        task_meta = self.meta.setdefault(taskid, {})
+        if parts[1] == "inventory":
+            partial = {}
+            for relpath, file_meta in task_meta.items():
+                if not file_meta["complete"]:
+                    partial[relpath] = os.path.getsize(self.get_path(taskid, relpath))
+            return 200, {"files": {relpath: {"size": file_meta["size"], "crc": file_meta["crc"]}
+                                   for relpath, file_meta in task_meta.items() if file_meta["complete"]},
+                         "partial": partial}
+        relpath = "/".join(parts[2:])
+        file_path = self.get_path(taskid, relpath)
+        received = os.path.getsize(file_path) if relpath in task_meta else 0
+        if method == "GET":
+            return 200, {"offset": received}
+        content_range = headers["content-range"].split()[1]
+        first = 0 if content_range.startswith("*") else int(content_range.split("-")[0])
+        if first != received:
+            return 409, {"offset": received}
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "ab" if first else "wb") as f:
+            f.write(body)
+        size = int(headers["x-size"])
+        task_meta[relpath] = {"size": str(size), "crc": headers["x-crc32"], "complete": first + len(body) >= size}
+        return 200, {"offset": first + len(body)}
+
+
+def test_publish(tmp_path):
+    import pytest
+    task_dir = tmp_path / "1234567890"
+    files_dir = task_dir / "Contents" / "Files"
+    files_dir.mkdir(parents=True)
+    datas = {"a.JPG": os.urandom(3000), "b.JPG": os.urandom(100)}
+    root = ET.Element("config")
+    filelist = ET.SubElement(root, "filelist")
+    for name, data in datas.items():
+        (files_dir / name).write_bytes(data)
+        ET.SubElement(filelist, "file", crc=str(zlib.crc32(data)), name=name, size=str(len(data)))
+    ET.ElementTree(root).write(str(task_dir / "Contents" / "filelist.xml"))
+    for name in UPLOAD_ORDER[1:]:
+        (task_dir / "Contents" / name).write_text("<config/>")
+
+    async def run():
+        # 第2次PUT断开连接，上传应从已收到的位置继续
+        server = StubServer(str(tmp_path / "target"), fail_puts=[2])
+        url = await server.start()
+        try:
+            publisher, results = await publish_task_dirs([str(task_dir)], url, chunk_size=1024, retries=2)
+            assert results == {str(task_dir): None}
+            assert publisher.uploaded == 6
+            assert (tmp_path / "target" / "1234567890" / "Contents" / "Files" / "a.JPG").read_bytes() == datas["a.JPG"]
+            publisher, _ = await publish_task_dirs([str(task_dir)], url)
+            assert publisher.skipped == 6 and publisher.bytes_sent == 0
+            # 文件比登记的大小短时不应无限发送空数据
+            publisher = Publisher(HttpEndpoint(url), retries=1, backoff=0)
+            with pytest.raises(PublishError):
+                await publisher.upload_file("1234567890", "Contents/Files/b.JPG", str(files_dir / "b.JPG"),
+                                            200, "0")
+        finally:
+            await server.stop()
+
+    asyncio.run(run())
@@ -1,179 +1,381 @@
-#!/usr/bin/env python3
-# -*- coding:utf-8 -*-
-'''
-Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
-
-description
-
-Author: Jeff Li <lijinfeng01@inspur.com>
-Date: 2021/03/26 13:42:31
-'''
-
-
-import collections
-import datetime
-import os
-
-
-Schedule = collections.namedtuple("Schedule", ["category", "week_days", "instance", "starttime", "stoptime", "minutes"])
-
-
-BEFORE_CLASS_SCHEDULE = [
-    Schedule("早读",   [0, 1, 2, 3, 4], 1,    "06:50:00", "08:00:00", None),
-    Schedule("课间操", [0, 1, 2, 3, 4], 2,    "08:40:00", None,       30),
-    Schedule("课间",   [0, 1, 2, 3, 4], 3,    "09:50:00", None,       10),
-    Schedule("课间",   [0, 1, 2, 3, 4], 4,    "10:45:00", None,       10),
-    Schedule("午休",   [0, 1, 2, 3,  ], 5,    "11:35:00", "13:30:00", None),
-    Schedule("午休",   [            4], 5,    "11:35:00", "13:00:00", None),
-    Schedule("课间",   [0, 1, 2, 3,  ], 6,    "14:10:00", None,       10),
-    Schedule("课间",   [            4], 6,    "13:40:00", None,       10),
-    Schedule("课间",   [0, 1, 2, 3,  ], 7,    "15:05:00", None,       10),
-    Schedule("课间",   [0, 1, 2, 3,  ], 8,    "15:55:00", None,       10),
-]
-
-ELECTIVE_CLASS_SCHEDULE = Schedule("课程",   [             ], 7,    "15:15:00", None,       90)
-
-CLASS_SCHEDULES = [
-    Schedule("课程",   [0, 1, 2, 3, 4], 1,    "08:00:00", None,       40),
-    Schedule("课程",   [0, 1, 2, 3, 4], 2,    "09:10:00", None,       40),
-    Schedule("课程",   [0, 1, 2, 3, 4], 3,    "10:00:00", None,       45),
-    Schedule("课程",   [0, 1, 2, 3, 4], 4,    "10:55:00", None,       40),
-    Schedule("课程",   [0, 1, 2, 3   ], 5,    "13:30:00", None,       40),
-    Schedule("课程",   [            4], 5,    "13:00:00", None,       40),
-    Schedule("课程",   [0, 1, 2, 3   ], 6,    "14:20:00", None,       45),
-    Schedule("课程",   [            4], 6,    "13:50:00", None,       45),
-    Schedule("课程",   [0, 1, 2, 3   ], 7,    "15:15:00", None,       40),
-    Schedule("课程",   [0, 1, 2, 3   ], 8,    "16:05:00", None,       40),
-]
-
-
-def get_schedule_before_class(week_day, instance):
-    for schedule in BEFORE_CLASS_SCHEDULE:
-        if week_day in schedule.week_days and instance == schedule.instance:
-            category, _, instance, starttime, stoptime, minutes = schedule
-            return Schedule(category, [week_day], instance, starttime, stoptime, minutes)
-    raise ValueError("No suitable schedule found before 星期{}第{}节".format(week_day + 1, instance))
-
-
-def get_class_schedule(week_day, instance):
-    for schedule in CLASS_SCHEDULES:
-        if week_day in schedule.week_days and instance == schedule.instance:
-            category, _, instance, starttime, stoptime, minutes = schedule
-            return Schedule(category, [week_day], instance, starttime, stoptime, minutes)
-    raise ValueError("No suitable schedule found for 星期{}第{}节".format(week_day + 1, instance))
-
-
-def calc_class_schedule_from_images(filenames):
-    basename_list = [os.path.basename(filename) for filename in filenames]
-    classes = set()
-    for basename in basename_list:
-        week_day_str, instance_str = os.path.splitext(basename)[0].split("-")
-        classes.add((int(week_day_str) - 1, int(instance_str)))
-
-    schedules = []
-    for week_day, instance in sorted(classes):
-        schedules.append(get_schedule_before_class(week_day, instance))
-        schedules.append(get_class_schedule(week_day, instance))
-
-    # 选修
-    eighth_classes = [(week_day, instance) for week_day, instance in classes if instance == 8]
-    if len(eighth_classes) > 0:
-        week_days = [week_day for week_day, _ in eighth_classes]
-        week_days_has_elective_class = set(range(4)) - set(week_days)
-        for week_day in week_days_has_elective_class:
-            replace_with_elective_class(schedules, week_day)
-
-    # 放学
-    add_schedule_after_class(schedules)
-
-    return schedules
-
-
-def test_calc_class_schedule_from_images():
-    filenames = ["1-7", "1-8"]
-    schedules = calc_class_schedule_from_images(filenames)
-    expected_schedules = [
-        Schedule(category='课间', week_days=[0], instance=7, starttime='15:05:00', stoptime=None, minutes=10),
-        Schedule(category='课程', week_days=[0], instance=7, starttime='15:15:00', stoptime=None, minutes=40),
-        Schedule(category='课间', week_days=[0], instance=8, starttime='15:55:00', stoptime=None, minutes=10),
-        Schedule(category='课程', week_days=[0], instance=8, starttime='16:05:00', stoptime=None, minutes=40),
-        Schedule(category='课程', week_days=[1], instance=7, starttime='15:15:00', stoptime=None, minutes=90),
-        Schedule(category='课程', week_days=[2], instance=7, starttime='15:15:00', stoptime=None, minutes=90),
-        Schedule(category='课程', week_days=[3], instance=7, starttime='15:15:00', stoptime=None, minutes=90),
-        Schedule(category='放学', week_days=[0], instance=None, starttime='16:45:00', stoptime=None, minutes=30),
-        Schedule(category='放学', week_days=[1], instance=None, starttime='16:45:00', stoptime=None, minutes=30),
-        Schedule(category='放学', week_days=[2], instance=None, starttime='16:45:00', stoptime=None, minutes=30),
-        Schedule(category='放学', week_days=[3], instance=None, starttime='16:45:00', stoptime=None, minutes=30),
-    ]
-    assert schedules == expected_schedules
-
-
-def replace_with_elective_class(schedules, week_day):
-    unneeded_schedules = []
-    for schedule in schedules:
-        if week_day in schedule.week_days:
-            if (schedule.category == "课程" and schedule.instance in [7, 8]) or (schedule.category == "课间" and schedule.instance in [8]):
-                unneeded_schedules.append(schedule)
-    if len(unneeded_schedules) >= 0:
-        for schedule in unneeded_schedules:
-            schedules.remove(schedule)
-        category, _, instance, starttime, stoptime, minutes = ELECTIVE_CLASS_SCHEDULE
-        schedules.append(Schedule(category, [week_day], instance, starttime, stoptime, minutes))
-    return schedules
-
-
-def test_replace_with_elective_class():
-    schedules = [
-        Schedule("课间",   [0,           ], 7,    "15:05:00", None,       40),
-        Schedule("课程",   [0,           ], 7,    "15:15:00", None,       40),
-        Schedule("课间",   [0,           ], 8,    "15:55:00", None,       10),
-        Schedule("课程",   [0,           ], 8,    "16:05:00", None,       40),
-    ]
-    replace_with_elective_class(schedules, 0)
-    expected_schedules = [
-        Schedule("课间",   [0,           ], 7,    "15:05:00", None,       40),
-        Schedule("课程",   [0,           ], 7,    "15:15:00", None,       90),
-    ]
-    assert schedules == expected_schedules
-
-
-def add_schedule_after_class(schedules):
-    fmt = "%H:%M:%S"
-    last_stoptimes = {}
-    for schedule in schedules:
-        category, week_days, instance, starttime, stoptime, minutes = schedule
-        if stoptime is None:
-            last_stop = datetime.datetime.strptime(starttime, fmt) + datetime.timedelta(minutes=minutes)
-        else:
-            last_stop = datetime.datetime.strptime(stoptime, fmt)
-        week_day = week_days[0]
-        if week_day not in last_stoptimes or last_stop > last_stoptimes[week_day]:
-            last_stoptimes[week_day] = last_stop
-
-    for week_day, last_stop in last_stoptimes.items():
-        schedule = Schedule("放学", [week_day], None, last_stop.strftime(fmt), None, 45)
-        schedules.append(schedule)
-
-
-def test_add_schedule_after_class():
-    schedules = [
-        Schedule("课程",   [            4], 6,    "13:50:00", None,       45),
-    ]
-    add_schedule_after_class(schedules)
-    expected_schedules = [
-        Schedule("课程",   [            4], 6,    "13:50:00", None,       45),
-        Schedule("放学",   [            4], None, "14:35:00", None,       30),
-    ]
-    assert schedules == expected_schedules
-
-
-if __name__ == "__main__":
-    import itertools
-    a = itertools.product(range(1, 6), range(1,9))
-    b = ["{}-{}.JPG".format(d,i) for d,i in a]
-    b.remove('1-8.JPG')
-    b.remove('5-7.JPG')
-    b.remove('5-8.JPG')
-    schedules = calc_class_schedule_from_images(b)
-    for schedule in schedules:
-        print(schedule)
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+description
+
+Author: Jeff Li <lijinfeng01@inspur.com>
+Date: 2021/03/26 13:42:31
+'''
+
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+
+
+Schedule = collections.namedtuple("Schedule", ["category", "week_days", "instance", "starttime", "stoptime", "minutes"])
+
+
+BEFORE_CLASS_SCHEDULE = [
+    Schedule("早读",   [0, 1, 2, 3, 4], 1,    "06:50:00", "08:00:00", None),
+    Schedule("课间操", [0, 1, 2, 3, 4], 2,    "08:40:00", None,       30),
+    Schedule("课间",   [0, 1, 2, 3, 4], 3,    "09:50:00", None,       10),
+    Schedule("课间",   [0, 1, 2, 3, 4], 4,    "10:45:00", None,       10),
+    Schedule("午休",   [0, 1, 2, 3,  ], 5,    "11:35:00", "13:30:00", None),
+    Schedule("午休",   [            4], 5,    "11:35:00", "13:00:00", None),
+    Schedule("课间",   [0, 1, 2, 3,  ], 6,    "14:10:00", None,       10),
+    Schedule("课间",   [            4], 6,    "13:40:00", None,       10),
+    Schedule("课间",   [0, 1, 2, 3,  ], 7,    "15:05:00", None,       10),
+    Schedule("课间",   [0, 1, 2, 3,  ], 8,    "15:55:00", None,       10),
+]
+
+ELECTIVE_CLASS_SCHEDULE = Schedule("课程",   [             ], 7,    "15:15:00", None,       90)
+
+CLASS_SCHEDULES = [
+    Schedule("课程",   [0, 1, 2, 3, 4], 1,    "08:00:00", None,       40),
+    Schedule("课程",   [0, 1, 2, 3, 4], 2,    "09:10:00", None,       40),
+    Schedule("课程",   [0, 1, 2, 3, 4], 3,    "10:00:00", None,       45),
+    Schedule("课程",   [0, 1, 2, 3, 4], 4,    "10:55:00", None,       40),
+    Schedule("课程",   [0, 1, 2, 3   ], 5,    "13:30:00", None,       40),
+    Schedule("课程",   [            4], 5,    "13:00:00", None,       40),
+    Schedule("课程",   [0, 1, 2, 3   ], 6,    "14:20:00", None,       45),
+    Schedule("课程",   [            4], 6,    "13:50:00", None,       45),
+    Schedule("课程",   [0, 1, 2, 3   ], 7,    "15:15:00", None,       40),
+    Schedule("课程",   [0, 1, 2, 3   ], 8,    "16:05:00", None,       40),
+]
+
+
+class Timetable:
+    """
+    Bell schedules compiled into dicts keyed by (week_day, instance)
+    """
+    def __init__(self, before_class_schedules, class_schedules, elective_class_schedule):
+        self.before_class = self.compile(before_class_schedules)
+        self.classes = self.compile(class_schedules)
+        self.elective_class = elective_class_schedule
+
+    @staticmethod
+    def compile(schedules):
+        index = {}
+        for schedule in schedules:
+            category, week_days, instance, starttime, stoptime, minutes = schedule
+            for week_day in week_days:
+                index.setdefault((week_day, instance), Schedule(category, [week_day], instance, starttime, stoptime, minutes))
+        return index
+
+    @staticmethod
+    def parse_schedule(item):
+        """
+        Schedule from a [category, week_days, instance, starttime, stoptime,
+        minutes] row or a table of those keys, where stoptime and minutes
+        may be left out since TOML has no null
+        """
+        if isinstance(item, dict):
+            return Schedule(**{"stoptime": None, "minutes": None, **item})
+        return Schedule(*item)
+
+    @classmethod
+    def from_dict(cls, data):
+        before_class_schedules = [cls.parse_schedule(item) for item in data["before_class"]]
+        class_schedules = [cls.parse_schedule(item) for item in data["class"]]
+        elective_class_schedule = cls.parse_schedule(data["elective"]) if data.get("elective") else ELECTIVE_CLASS_SCHEDULE
+        return cls(before_class_schedules, class_schedules, elective_class_schedule)
+
+    def to_dict(self):
+        """
+        Rows from_dict() turns back into this timetable, one per week day
+        """
+        return {
+            "before_class": [list(schedule) for schedule in self.before_class.values()],
+            "class": [list(schedule) for schedule in self.classes.values()],
+            "elective": list(self.elective_class),
+        }
+
+    def get_schedule_before_class(self, week_day, instance):
+        schedule = self.before_class.get((week_day, instance))
+        if schedule is None:
+            raise ValueError("No suitable schedule found before 星期{}第{}节".format(week_day + 1, instance))
+        return schedule._replace(week_days=[week_day])
+
+    def get_class_schedule(self, week_day, instance):
+        schedule = self.classes.get((week_day, instance))
+        if schedule is None:
+            raise ValueError("No suitable schedule found for 星期{}第{}节".format(week_day + 1, instance))
+        return schedule._replace(week_days=[week_day])
+
+
+DEFAULT_TIMETABLE = Timetable(BEFORE_CLASS_SCHEDULE, CLASS_SCHEDULES, ELECTIVE_CLASS_SCHEDULE)
+
+TIMETABLES = {}
+DEFAULT_CACHE_PATH = ".ppt2ad-timetables"
+# Timetable或Schedule结构变化时加一，旧的编译结果会重新生成
+COMPILED_FORMAT = 2
+
+def read_timetable_file(path):
+    """
+    Read a JSON or TOML timetable file into {name: timetable data}
+
+    The file either holds one timetable (before_class/class/elective) or a
+    "timetables" table of them, named e.g. "<school>/<term>".
+    """
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    if "timetables" in data:
+        return data["timetables"]
+    return {"default": data}
+
+
+def get_compiled_path(path, cache_dir=DEFAULT_CACHE_PATH):
+    key = hashlib.md5(os.path.abspath(path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key + ".json")
+
+
+def load_compiled(compiled_path, signature):
+    """
+    Timetables from a compiled JSON file, or None if it is missing or stale
+    """
+    try:
+        with open(compiled_path, "r", encoding="utf-8") as f:
+            compiled = json.load(f)
+        if compiled["signature"] != signature:
+            return None
+        return {timetable_name: Timetable.from_dict(data) for timetable_name, data in compiled["timetables"].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        # 损坏或旧格式的编译结果重新生成
+        return None
+
+
+def save_compiled(compiled_path, signature, timetables):
+    compiled = {
+        "signature": signature,
+        "timetables": {timetable_name: timetable.to_dict() for timetable_name, timetable in timetables.items()},
+    }
+    tmp_path = "{}.{}.tmp".format(compiled_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(compiled, f, ensure_ascii=False)
+        os.replace(tmp_path, compiled_path)
+    except OSError:
+        pass
+
+
+def load_timetable(path=None, name=None, cache_dir=DEFAULT_CACHE_PATH):
+    """
+    Load a compiled timetable, reusing the compiled form kept in cache_dir
+
+    The compiled form is plain JSON, so a writable cache directory cannot
+    inject code.
+    """
+    if path is None:
+        return DEFAULT_TIMETABLE
+    stat = os.stat(path)
+    key = (os.path.abspath(path), name, stat.st_size, stat.st_mtime_ns)
+    if key in TIMETABLES:
+        return TIMETABLES[key]
+
+    signature = [COMPILED_FORMAT, stat.st_size, stat.st_mtime_ns]
+    compiled_path = get_compiled_path(path, cache_dir)
+    timetables = load_compiled(compiled_path, signature)
+    if timetables is None:
+        timetables = {timetable_name: Timetable.from_dict(data)
+                      for timetable_name, data in read_timetable_file(path).items()}
+        save_compiled(compiled_path, signature, timetables)
+
+    if name is None:
+        if len(timetables) != 1:
+            raise ValueError("{} holds several timetables, choose one of {}".format(path, ", ".join(sorted(timetables))))
+        name = next(iter(timetables))
+    if name not in timetables:
+        raise ValueError("No timetable named {} in {}".format(name, path))
+    TIMETABLES[key] = timetables[name]
+    return timetables[name]
+
+def get_schedule_before_class(week_day, instance, timetable=DEFAULT_TIMETABLE):
+    return timetable.get_schedule_before_class(week_day, instance)
+
+
+def get_class_schedule(week_day, instance, timetable=DEFAULT_TIMETABLE):
+    return timetable.get_class_schedule(week_day, instance)
+
+
+def calc_class_schedule_from_images(filenames, timetable=DEFAULT_TIMETABLE):
+    basename_list = [os.path.basename(filename) for filename in filenames]
+    classes = set()
+    for basename in basename_list:
+        week_day_str, instance_str = os.path.splitext(basename)[0].split("-")
+        classes.add((int(week_day_str) - 1, int(instance_str)))
+
+    schedules = []
+    for week_day, instance in sorted(classes):
+        schedules.append(timetable.get_schedule_before_class(week_day, instance))
+        schedules.append(timetable.get_class_schedule(week_day, instance))
+
+    # 选修
+    eighth_classes = [(week_day, instance) for week_day, instance in classes if instance == 8]
+    if len(eighth_classes) > 0:
+        week_days = [week_day for week_day, _ in eighth_classes]
+        week_days_has_elective_class = set(range(4)) - set(week_days)
+        replace_with_elective_classes(schedules, sorted(week_days_has_elective_class), timetable.elective_class)
+
+    # 放学
+    add_schedule_after_class(schedules)
+
+    return schedules
+
+
+def test_calc_class_schedule_from_images():
+    filenames = ["1-7", "1-8"]
+    schedules = calc_class_schedule_from_images(filenames)
+    expected_schedules = [
+        Schedule(category='课间', week_days=[0], instance=7, starttime='15:05:00', stoptime=None, minutes=10),
+        Schedule(category='课程', week_days=[0], instance=7, starttime='15:15:00', stoptime=None, minutes=40),
+        Schedule(category='课间', week_days=[0], instance=8, starttime='15:55:00', stoptime=None, minutes=10),
+        Schedule(category='课程', week_days=[0], instance=8, starttime='16:05:00', stoptime=None, minutes=40),
+        Schedule(category='课程', week_days=[1], instance=7, starttime='15:15:00', stoptime=None, minutes=90),
+        Schedule(category='课程', week_days=[2], instance=7, starttime='15:15:00', stoptime=None, minutes=90),
+        Schedule(category='课程', week_days=[3], instance=7, starttime='15:15:00', stoptime=None, minutes=90),
+        Schedule(category='放学', week_days=[0], instance=None, starttime='16:45:00', stoptime=None, minutes=30),
+        Schedule(category='放学', week_days=[1], instance=None, starttime='16:45:00', stoptime=None, minutes=30),
+        Schedule(category='放学', week_days=[2], instance=None, starttime='16:45:00', stoptime=None, minutes=30),
+        Schedule(category='放学', week_days=[3], instance=None, starttime='16:45:00', stoptime=None, minutes=30),
+    ]
+    assert schedules == expected_schedules
+
+
+def replace_with_elective_class(schedules, week_day):
+    return replace_with_elective_classes(schedules, [week_day])
+
+
+def replace_with_elective_classes(schedules, week_days, elective_class_schedule=ELECTIVE_CLASS_SCHEDULE):
+    elective_week_days = set(week_days)
+
+    def is_unneeded(schedule):
+        if elective_week_days.isdisjoint(schedule.week_days):
+            return False
+        return (schedule.category == "课程" and schedule.instance in [7, 8]) or (schedule.category == "课间" and schedule.instance in [8])
+
+    schedules[:] = [schedule for schedule in schedules if not is_unneeded(schedule)]
+    category, _, instance, starttime, stoptime, minutes = elective_class_schedule
+    for week_day in week_days:
+        schedules.append(Schedule(category, [week_day], instance, starttime, stoptime, minutes))
+    return schedules
+
+
+def test_replace_with_elective_class():
+    schedules = [
+        Schedule("课间",   [0,           ], 7,    "15:05:00", None,       40),
+        Schedule("课程",   [0,           ], 7,    "15:15:00", None,       40),
+        Schedule("课间",   [0,           ], 8,    "15:55:00", None,       10),
+        Schedule("课程",   [0,           ], 8,    "16:05:00", None,       40),
+    ]
+    replace_with_elective_class(schedules, 0)
+    expected_schedules = [
+        Schedule("课间",   [0,           ], 7,    "15:05:00", None,       40),
+        Schedule("课程",   [0,           ], 7,    "15:15:00", None,       90),
+    ]
+    assert schedules == expected_schedules
+
+
+def test_load_timetable(tmp_path):
+    data = {
+        "timetables": {
+            "一中/2021春": {
+                "before_class": [list(schedule) for schedule in BEFORE_CLASS_SCHEDULE],
+                "class": [list(schedule) for schedule in CLASS_SCHEDULES],
+                "elective": list(ELECTIVE_CLASS_SCHEDULE),
+            },
+            "一中/2021秋": {
+                "before_class": [["早读", [0], 1, "07:00:00", "08:00:00", None]],
+                "class": [["课程", [0], 1, "08:00:00", None, 45]],
+            },
+        },
+    }
+    path = str(tmp_path / "timetable.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    cache_dir = str(tmp_path / "cache")
+    filenames = ["1-1.JPG", "2-8.JPG", "5-6.JPG"]
+    timetable = load_timetable(path, "一中/2021春", cache_dir)
+    assert calc_class_schedule_from_images(filenames, timetable) == calc_class_schedule_from_images(filenames)
+    assert os.path.exists(get_compiled_path(path, cache_dir))
+    # 从编译结果读取的时间表与直接读取的相同
+    TIMETABLES.clear()
+    assert load_timetable(path, "一中/2021春", cache_dir).classes == timetable.classes
+    timetable = load_timetable(path, "一中/2021秋", cache_dir)
+    assert timetable.get_class_schedule(0, 1) == Schedule("课程", [0], 1, "08:00:00", None, 45)
+
+    # 文件修改后不再使用缓存的时间表
+    data["timetables"]["一中/2021秋"]["class"][0][-1] = 40
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    timetable = load_timetable(path, "一中/2021秋", cache_dir)
+    assert timetable.get_class_schedule(0, 1).minutes == 40
+
+    toml_path = str(tmp_path / "timetable.toml")
+    with open(toml_path, "w", encoding="utf-8") as f:
+        f.write('[[before_class]]\ncategory = "早读"\nweek_days = [0]\ninstance = 1\n'
+                'starttime = "07:00:00"\nstoptime = "08:00:00"\n\n'
+                '[[class]]\ncategory = "课程"\nweek_days = [0]\ninstance = 1\nstarttime = "08:00:00"\nminutes = 45\n')
+    # 损坏的编译结果
+    compiled_path = get_compiled_path(toml_path, cache_dir)
+    with open(compiled_path, "w", encoding="utf-8") as f:
+        f.write('{"signature": ')
+    timetable = load_timetable(toml_path, cache_dir=cache_dir)
+    assert timetable.get_schedule_before_class(0, 1) == Schedule("早读", [0], 1, "07:00:00", "08:00:00", None)
+    assert timetable.get_class_schedule(0, 1) == Schedule("课程", [0], 1, "08:00:00", None, 45)
+    with open(compiled_path, "r", encoding="utf-8") as f:
+        assert json.load(f)["signature"][0] == COMPILED_FORMAT
+    assert sorted(os.listdir(str(tmp_path))) == ["cache", "timetable.json", "timetable.toml"]
+
+
+def add_schedule_after_class(schedules):
+    fmt = "%H:%M:%S"
+    last_stoptimes = {}
+    for schedule in schedules:
+        category, week_days, instance, starttime, stoptime, minutes = schedule
+        if stoptime is None:
+            last_stop = datetime.datetime.strptime(starttime, fmt) + datetime.timedelta(minutes=minutes)
+        else:
+            last_stop = datetime.datetime.strptime(stoptime, fmt)
+        week_day = week_days[0]
+        if week_day not in last_stoptimes or last_stop > last_stoptimes[week_day]:
+            last_stoptimes[week_day] = last_stop
+
+    for week_day, last_stop in last_stoptimes.items():
+        schedule = Schedule("放学", [week_day], None, last_stop.strftime(fmt), None, 45)
+        schedules.append(schedule)
+
+
+def test_add_schedule_after_class():
+    schedules = [
+        Schedule("课程",   [            4], 6,    "13:50:00", None,       45),
+    ]
+    add_schedule_after_class(schedules)
+    expected_schedules = [
+        Schedule("课程",   [            4], 6,    "13:50:00", None,       45),
+        Schedule("放学",   [            4], None, "14:35:00", None,       30),
+    ]
+    assert schedules == expected_schedules
+
+
+if __name__ == "__main__":
+    import itertools
+    a = itertools.product(range(1, 6), range(1,9))
+    b = ["{}-{}.JPG".format(d,i) for d,i in a]
+    b.remove('1-8.JPG')
+    b.remove('5-7.JPG')
+    b.remove('5-8.JPG')
+    schedules = calc_class_schedule_from_images(b)
+    for schedule in schedules:
+        print(schedule)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Content-addressed asset store shared by task directories
+'''
+
+import errno
+import os
+
+from . import manifest
+from . import materialize
+
+
+DEFAULT_STORE_PATH = ".ppt2ad-store"
+LINK_MODES = ["hardlink", "symlink"]
+
+
+class AssetStore:
+    """
+    Blobs named by their MD5 digest under <root>/<2 hex digits>/<digest>
+
+    Task directories reference blobs through hardlinks or symlinks, so a
+    file shared by many boards is stored and written once.
+    """
+    def __init__(self, root=DEFAULT_STORE_PATH, link_mode="hardlink", materializer=None):
+        if link_mode not in LINK_MODES:
+            raise ValueError("Unknown store link mode: {}".format(link_mode))
+        self.root = root
+        self.link_mode = link_mode
+        if materializer is None:
+            materializer = materialize.Materializer()
+        self.materializer = materializer
+        self.added = 0
+        self.reused = 0
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def add(self, src_path, digest):
+        blob_path = self.get_blob_path(digest)
+        if os.path.exists(blob_path):
+            self.reused += 1
+            return blob_path
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        self.materializer.materialize(src_path, blob_path)
+        self.added += 1
+        return blob_path
+
+    def place(self, src_path, digest, dst_path):
+        """
+        Make dst_path a link to the blob of digest, adding src_path if needed
+        """
+        blob_path = self.add(src_path, digest)
+        tmp_path = "{}.{}.tmp".format(dst_path, os.getpid())
+        try:
+            if self.link_mode == "symlink":
+                os.symlink(os.path.abspath(blob_path), tmp_path)
+            else:
+                os.link(blob_path, tmp_path)
+        except OSError as e:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            if e.errno not in materialize.LINK_UNSUPPORTED_ERRNOS:
+                raise
+            # 跨文件系统等无法链接时退回为复制
+            self.materializer.materialize(blob_path, dst_path)
+            return
+        os.replace(tmp_path, dst_path)
+
+    def iter_blobs(self):
+        if not os.path.isdir(self.root):
+            return
+        for prefix in sorted(os.listdir(self.root)):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for digest in sorted(os.listdir(prefix_dir)):
+                yield digest, os.path.join(prefix_dir, digest)
+
+    def gc(self, task_dirs, dry_run=False):
+        """
+        Remove blobs that no manifest in task_dirs references
+
+        Returns (removed blob count, freed bytes).
+        """
+        referenced = set()
+        for task_dir in task_dirs:
+            task_manifest = manifest.load_manifest(task_dir)
+            if task_manifest is not None:
+                referenced.update(task_manifest["files"].values())
+        removed = 0
+        freed = 0
+        for digest, blob_path in list(self.iter_blobs()):
+            if digest in referenced:
+                continue
+            removed += 1
+            stat = os.stat(blob_path)
+            # 仍有硬链接的文件删除后不会释放空间
+            if stat.st_nlink <= 1:
+                freed += stat.st_size
+            if not dry_run:
+                os.remove(blob_path)
+        return removed, freed
+
+    def summary(self):
+        return "asset store: {} added, {} reused".format(self.added, self.reused)
+
+
+def find_task_dirs(root="."):
+    return sorted(
+        os.path.join(root, name) for name in os.listdir(root)
+        if os.path.isfile(manifest.get_manifest_path(os.path.join(root, name)))
+    )
+
+
+def test_gc(tmp_path):
+    store_root = str(tmp_path / "store")
+    asset_store = AssetStore(store_root)
+    blobs = {}
+    for name, data in [("a.JPG", b"a" * 100), ("b.JPG", b"b" * 200), ("c.JPG", b"c" * 300)]:
+        src = tmp_path / name
+        src.write_bytes(data)
+        digest = name[0] * 32
+        blobs[name] = asset_store.add(str(src), digest)
+    task_dir = tmp_path / "1234567890"
+    task_dir.mkdir()
+    manifest.save_manifest(str(task_dir), {"inputs": {}, "xml": {}, "files": {"a.JPG": "a" * 32, "b.JPG": "b" * 32}})
+    assert find_task_dirs(str(tmp_path)) == [str(task_dir)]
+
+    assert asset_store.gc([str(task_dir)], dry_run=True) == (1, 300)
+    assert all(os.path.exists(blob_path) for blob_path in blobs.values())
+
+    assert asset_store.gc([str(task_dir)]) == (1, 300)
+    assert os.path.exists(blobs["a.JPG"]) and os.path.exists(blobs["b.JPG"])
+    assert not os.path.exists(blobs["c.JPG"])
+    assert asset_store.gc([str(task_dir)]) == (0, 0)
+
+
+def test_place_fallback(tmp_path, monkeypatch):
+    import pytest
+    src = tmp_path / "a.JPG"
+    src.write_bytes(b"jpeg")
+    asset_store = AssetStore(str(tmp_path / "store"))
+    asset_store.add(str(src), "a" * 32)
+
+    def fail(code):
+        def link(src_path, dst_path):
+            raise OSError(code, os.strerror(code))
+        return link
+
+    monkeypatch.setattr(os, "link", fail(errno.EXDEV))
+    asset_store.place(str(src), "a" * 32, str(tmp_path / "b.JPG"))
+    assert (tmp_path / "b.JPG").read_bytes() == b"jpeg"
+    # 磁盘满等错误不能被复制掩盖
+    monkeypatch.setattr(os, "link", fail(errno.ENOSPC))
+    with pytest.raises(OSError):
+        asset_store.place(str(src), "a" * 32, str(tmp_path / "c.JPG"))
+    assert not (tmp_path / "c.JPG").exists()
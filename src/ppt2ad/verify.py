@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+'''
+Copyright (c) 2021 Inspur.com, Inc. All Rights Reserved
+
+Check generated task packages for consistency
+'''
+
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import xml.etree.ElementTree as ET
+import zlib
+
+from . import archive
+from . import manifest
+
+
+def hash_file(file_path, md5=False):
+    """
+    Size, CRC-32 and optionally MD5 of a file, read through mmap
+
+    zlib and hashlib release the GIL on large buffers, so a thread pool
+    hashes several files at disk speed.
+    """
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0, 0, hashlib.md5().hexdigest() if md5 else None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            crc = zlib.crc32(data)
+            digest = hashlib.md5(data).hexdigest() if md5 else None
+    return size, crc, digest
+
+
+def iter_elements(xml_path, tag):
+    for _, elm in ET.iterparse(xml_path):
+        if elm.tag == tag:
+            yield elm
+            elm.clear()
+
+
+class PackageReport:
+    def __init__(self, task_dir):
+        self.task_dir = task_dir
+        self.problems = []
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, check, path, message):
+        self.problems.append({"check": check, "path": path, "message": message})
+
+    def to_dict(self):
+        return {
+            "task_dir": self.task_dir,
+            "ok": not self.problems,
+            "files": self.files,
+            "bytes": self.bytes,
+            "problems": self.problems,
+        }
+
+
+def check_file(file_path, size, crc, digest):
+    """
+    Return (actual size, list of (check, message)) for one Files entry
+    """
+    if not os.path.isfile(file_path):
+        return 0, [("missing", "file does not exist")]
+    actual_size, actual_crc, actual_digest = hash_file(file_path, md5=digest is not None)
+    problems = []
+    if size != str(actual_size):
+        problems.append(("size", "filelist says {}, file has {}".format(size, actual_size)))
+    if not archive.crc_matches(crc, actual_crc):
+        problems.append(("crc", "filelist says {}, file has {}".format(crc, archive.format_crc(actual_crc, like=crc))))
+    if digest is not None and digest != actual_digest:
+        problems.append(("digest", "manifest says {}, file has {}".format(digest, actual_digest)))
+    return actual_size, problems
+
+
+def verify_package(task_dir, executor):
+    """
+    Check one <taskid>/Contents, hashing its Files on executor
+    """
+    report = PackageReport(task_dir)
+    contents_dir = os.path.join(task_dir, "Contents")
+    xml_paths = {name: os.path.join(contents_dir, name) for name in manifest.XML_DOCUMENTS}
+    for name, xml_path in xml_paths.items():
+        if not os.path.isfile(xml_path):
+            report.add("missing", "Contents/" + name, "document does not exist")
+    if report.problems:
+        return report
+
+    try:
+        filelist = {elm.get("name"): (elm.get("size"), elm.get("crc"))
+                    for elm in iter_elements(xml_paths["filelist.xml"], "file")}
+        program_ids = set()
+        for program_elm in iter_elements(xml_paths["playlist.xml"], "program"):
+            program_ids.add(program_elm.get("id"))
+            for img_elm in program_elm.iter("img"):
+                if img_elm.get("path") not in filelist:
+                    report.add("img", "Contents/playlist.xml", "program {} shows {} which is not in filelist.xml".format(
+                        program_elm.get("name"), img_elm.get("path")))
+        for program_elm in iter_elements(xml_paths["tacticlist.xml"], "program"):
+            if program_elm.get("id") not in program_ids:
+                report.add("program", "Contents/tacticlist.xml",
+                           "program id {} is not in playlist.xml".format(program_elm.get("id")))
+    except ET.ParseError as e:
+        report.add("xml", contents_dir, str(e))
+        return report
+
+    # 增量生成的任务目录带有manifest，可以同时校验MD5
+    digests = {}
+    task_manifest = manifest.load_manifest(task_dir)
+    if task_manifest is not None:
+        digests = {name: digest for name, digest in task_manifest["files"].items() if not digest.startswith("stat:")}
+
+    files_dir = os.path.join(contents_dir, "Files")
+    futures = {}
+    for name, (size, crc) in filelist.items():
+        future = executor.submit(check_file, os.path.join(files_dir, name), size, crc, digests.get(name))
+        futures[future] = name
+    for future in concurrent.futures.as_completed(futures):
+        name = futures[future]
+        size, problems = future.result()
+        report.files += 1
+        report.bytes += size
+        for check, message in problems:
+            report.add(check, "Contents/Files/" + name, message)
+    if os.path.isdir(files_dir):
+        for name in sorted(set(os.listdir(files_dir)) - set(filelist)):
+            report.add("unlisted", "Contents/Files/" + name, "file is not in filelist.xml")
+    report.problems.sort(key=lambda problem: (problem["path"], problem["check"]))
+    return report
+
+
+def verify_packages(task_dirs, jobs=None, hash_workers=None):
+    """
+    Verify packages concurrently, returning their reports in task_dirs order
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=hash_workers) as hash_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as package_executor:
+        return list(package_executor.map(lambda task_dir: verify_package(task_dir, hash_executor), task_dirs))
+
+
+def format_report(report):
+    lines = ["{} {}: {} files, {:.1f} MB".format(
+        "OK    " if not report.problems else "FAILED", report.task_dir, report.files, report.bytes / 1048576)]
+    for problem in report.problems:
+        lines.append("    {:<9} {}: {}".format(problem["check"], problem["path"], problem["message"]))
+    return "\n".join(lines)
+
+
+def test_verify_package(tmp_path):
+    import time
+    from . import core
+    tasklist = core.TaskList("test", startdate=time.localtime(), stopdate=time.localtime(), stable_ids=True)
+    image_path = tmp_path / "a.JPG"
+    image_path.write_bytes(b"jpeg" * 100)
+    # 素材库用十六进制记录crc时同样认为一致
+    assert check_file(str(image_path), "400", "{:08X}".format(zlib.crc32(b"jpeg" * 100)), None) == (400, [])
+    tasklist.set_filelist({"a.JPG": core.Asset("a.JPG", str(image_path), "400",
+                                               archive.format_crc(zlib.crc32(b"jpeg" * 100)),
+                                               digest=hashlib.md5(b"jpeg" * 100).hexdigest())})
+    program = core.Program("早读", program_id="1")
+    program.create_imagerect([core.ImageEntry("a.JPG", "a.JPG")], rectid="2")
+    tasklist.programlist.append(program)
+    tasklist.add_schedule(program, starttime="07:00:00", stoptime="07:30:00", week_days=[0])
+    cwd = os.getcwd()
+    os.chdir(str(tmp_path))
+    try:
+        tasklist.save()
+        task_dir = tasklist.get_task_dir()
+        assert verify_packages([task_dir])[0].problems == []
+        with open(os.path.join(task_dir, "Contents", "Files", "a.JPG"), "ab") as f:
+            f.write(b"x")
+        open(os.path.join(task_dir, "Contents", "Files", "b.JPG"), "wb").close()
+        report = verify_packages([task_dir])[0]
+        assert [problem["check"] for problem in report.problems] == ["crc", "digest", "size", "unlisted"]
+    finally:
+        os.chdir(cwd)